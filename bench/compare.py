@@ -0,0 +1,66 @@
+import argparse
+import json
+import sys
+
+# Compare two results of load.py, flagging the operations whose latency grew
+# by more than the threshold or which run more queries than before. The exit
+# status is 1 if there are regressions, so that it can gate a CI job.
+
+METRICS = ["p50", "p95", "p99", "throughput", "queries_per_request"]
+
+def compare(baseline, current, threshold=10.0):
+    """
+    Return the rows (operation, metric, baseline, current, change in percent,
+    regression) of the operations of both runs.
+    """
+    rows = []
+    for op in sorted(set(baseline["operations"]) & set(current["operations"])):
+        before = baseline["operations"][op]
+        after = current["operations"][op]
+        for metric in METRICS:
+            b = before.get(metric)
+            a = after.get(metric)
+            if b is None or a is None:
+                continue
+            change = (a - b) / b * 100.0 if b else 0.0
+            if metric == "throughput":
+                regression = change < -threshold
+            elif metric == "queries_per_request":
+                regression = a > b + 0.5
+            else:
+                regression = metric != "p50" and change > threshold
+            rows.append((op, metric, b, a, change, regression))
+    return rows
+
+def main(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    print("baseline %s (%s), current %s (%s)" % (
+        args.baseline, baseline.get("commit"), args.current, current.get("commit")))
+    rows = compare(baseline, current, args.threshold)
+    print("%-24s %-20s %10s %10s %8s" %
+        ("operation", "metric", "baseline", "current", "change"))
+    for op, metric, b, a, change, regression in rows:
+        print("%-24s %-20s %10.2f %10.2f %+7.1f%%%s" %
+            (op, metric, b, a, change, "  REGRESSION" if regression else ""))
+
+    for op in sorted(set(baseline["operations"]) ^ set(current["operations"])):
+        print("%-24s only in the %s run" %
+            (op, "baseline" if op in baseline["operations"] else "current"))
+
+    regressions = sum(row[-1] for row in rows)
+    print("%d regression(s)" % regressions)
+    return 1 if regressions else 0
+
+
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare two load test results")
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0,
+        help="latency and throughput change (in percent) reported as a regression")
+    sys.exit(main(parser.parse_args()))
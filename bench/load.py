@@ -0,0 +1,505 @@
+import argparse
+import base64
+import collections
+import datetime
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import psycopg2 as ps
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import db_utils
+import seed
+
+# Concurrent load driver of the API, run against a server and a database
+# seeded by seed.py. Every operation of swagger.yml has a scenario building
+# one timed request (some run untimed setup requests first, e.g. sending the
+# message that delete_message deletes). The results are saved as JSON, see
+# compare.py to compare two runs.
+
+SWAGGER = os.path.join(os.path.dirname(__file__), "..", "swagger.yml")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+# relative frequency of the operations in the mixed load
+DEFAULT_MIX = {
+    "add_user": 1,
+    "get_all_users": 2,
+    "send_message": 10,
+    "send_messages": 2,
+    "update_user": 1,
+    "get_user": 5,
+    "get_user_v2": 5,
+    "broadcast_message": 0.1,
+    "get_received_messages": 20,
+    "mark_read": 5,
+    "get_sent_messages": 10,
+    "search_messages": 5,
+    "get_unread_count": 20,
+    "stream_messages": 1,
+    "get_message": 20,
+    "delete_message": 2,
+    "get_job": 2,
+    "get_metrics": 0.1,
+}
+
+Request = collections.namedtuple(
+    "Request", ["method", "path", "body", "content_type", "user", "stream"])
+Request.__new__.__defaults__ = (None, None, None, False)
+
+class Client:
+    """
+    Keep-alive HTTP client of one load thread.
+    """
+
+    def __init__(self, url, timeout=30.0):
+        url = urllib.parse.urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port
+        self.timeout = timeout
+        self._connection = None
+        self._session_lsn = None
+
+    def send(self, request):
+        """
+        Send the request and return its status and body, streamed responses
+        are closed after their first event. The session token of the server
+        (with read replicas) is sent back so that the reads see the writes.
+        """
+        headers = {}
+        if self._session_lsn is not None:
+            headers["X-Session-LSN"] = self._session_lsn
+        if request.user is not None:
+            credentials = "%s:%s" % request.user
+            headers["Authorization"] = (
+                "Basic " + base64.b64encode(credentials.encode()).decode())
+        body = request.body
+        if request.content_type is not None:
+            headers["Content-Type"] = request.content_type
+            if request.content_type == "application/json":
+                body = json.dumps(body)
+
+        if self._connection is None:
+            self._connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        try:
+            self._connection.request(
+                request.method, request.path, body=body, headers=headers)
+            response = self._connection.getresponse()
+            self._session_lsn = (
+                response.getheader("X-Session-LSN") or self._session_lsn)
+            if request.stream and response.status == 200:
+                data = response.readline()
+                self.close()
+            else:
+                data = response.read()
+            return response.status, data
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+class Scenarios:
+    """
+    One method per operation id, returning the timed request.
+    """
+
+    def __init__(self, client, data, rng, prefix):
+        self.client = client
+        self.data = data
+        self.rng = rng
+        self.prefix = prefix
+
+    def _user(self):
+        # (user_id, username), the password is the username
+        return self.rng.choice(self.data["users"])
+
+    def _auth(self, user):
+        return (user[1], user[1])
+
+    def _message(self, sender):
+        receivers = self.rng.sample(
+            self.data["users"], min(3, len(self.data["users"])))
+        return {"receiver_ids": [r[0] for r in receivers],
+                "message_text": "load test message from %s" % sender[1]}
+
+    def _setup(self, request, status=200):
+        # untimed request preparing the timed one
+        response_status, body = self.client.send(request)
+        if response_status != status:
+            raise RuntimeError("setup request failed: %s %s -> %d" %
+                (request.method, request.path, response_status))
+        return json.loads(body)
+
+    def add_user(self):
+        name = self.prefix + "load_" + uuid.uuid4().hex[:12]
+        return Request("POST", "/users", {"username": name, "password": name},
+            "application/json", self._auth(self._user()))
+
+    def get_all_users(self):
+        return Request("GET", "/users?limit=100", user=self._auth(self._user()))
+
+    def send_message(self):
+        user = self._user()
+        return Request("POST", "/messages/", self._message(user),
+            "application/json", self._auth(user))
+
+    def send_messages(self):
+        user = self._user()
+        return Request("POST", "/messages/batch",
+            [self._message(user) for _ in range(10)],
+            "application/json", self._auth(user))
+
+    def update_user(self):
+        user = self._user()
+        return Request("PUT", "/users/%d" % user[0],
+            {"username": user[1], "password": user[1]},
+            "application/json", self._auth(user))
+
+    def get_user(self):
+        return Request("GET", "/users/%d" % self._user()[0],
+            user=self._auth(self._user()))
+
+    def get_user_v2(self):
+        return Request("GET", "/users/%s" % self._user()[1],
+            user=self._auth(self._user()))
+
+    def broadcast_message(self):
+        user = self._user()
+        return Request("POST", "/users/all",
+            "load test broadcast from %s" % user[1], "text/plain", self._auth(user))
+
+    def get_received_messages(self):
+        user = self._user()
+        return Request("GET", "/users/%d/received?limit=100" % user[0],
+            user=self._auth(user))
+
+    def mark_read(self):
+        message_id, receiver = self.rng.choice(self.data["received"])
+        return Request("POST", "/users/%d/received/read" % receiver[0],
+            {"message_ids": [message_id]}, "application/json", self._auth(receiver))
+
+    def get_sent_messages(self):
+        user = self._user()
+        return Request("GET", "/users/%d/sent?limit=100" % user[0],
+            user=self._auth(user))
+
+    def search_messages(self):
+        user = self._user()
+        query = " ".join(self.rng.sample(seed._WORDS, 2))
+        return Request("GET", "/users/%d/search?%s" % (
+            user[0], urllib.parse.urlencode({"q": query, "limit": 20})),
+            user=self._auth(user))
+
+    def get_unread_count(self):
+        user = self._user()
+        return Request("GET", "/users/%d/unread" % user[0], user=self._auth(user))
+
+    def stream_messages(self):
+        user = self._user()
+        return Request("GET", "/users/%d/stream" % user[0],
+            user=self._auth(user), stream=True)
+
+    def get_message(self):
+        message_id, receiver = self.rng.choice(self.data["received"])
+        return Request("GET", "/messages/%d" % message_id,
+            user=self._auth(receiver))
+
+    def delete_message(self):
+        user = self._user()
+        message_id = self._setup(Request("POST", "/messages/",
+            self._message(user), "application/json", self._auth(user)))
+        return Request("DELETE", "/messages/%d" % message_id, user=self._auth(user))
+
+    def get_job(self):
+        user = self._user()
+        job = self._setup(Request("POST", "/messages/?deferred=true",
+            self._message(user), "application/json", self._auth(user)), 202)
+        return Request("GET", "/jobs/%d" % job["job_id"], user=self._auth(user))
+
+    def get_metrics(self):
+        return Request("GET", "/metrics")
+
+def operation_ids(swagger=SWAGGER):
+    """
+    Return the names of the controller functions of swagger.yml.
+    """
+    with open(swagger) as f:
+        spec = yaml.safe_load(f)
+    return sorted(
+        operation["operationId"].rpartition(".")[2]
+        for path in spec["paths"].values()
+        for method, operation in path.items()
+        if isinstance(operation, dict) and "operationId" in operation)
+
+def load_data(database_url, prefix, sample_size=10000):
+    """
+    Read the seeded users and a sample of (message_id, receiver) pairs.
+    """
+    conn = ps.connect(database_url)
+    try:
+        cur = conn.cursor()
+        pattern = prefix.replace("_", "\\_") + "%"
+        cur.execute(
+            '''
+            SELECT user_id, username FROM Users
+            WHERE username LIKE %s AND username NOT LIKE %s
+            ORDER BY user_id;''',
+            [pattern, prefix.replace("_", "\\_") + "load\\_%"])
+        users = cur.fetchall()
+        cur.execute(
+            '''
+            SELECT r.message_id, u.user_id, u.username
+            FROM Receivers as r, Users as u
+            WHERE u.user_id = r.receiver_id AND u.username LIKE %s
+            LIMIT %s;''',
+            [pattern, sample_size])
+        received = [(m, (u, name)) for m, u, name in cur.fetchall()]
+        cur.close()
+    finally:
+        conn.close()
+    if not users or not received:
+        raise RuntimeError("no seeded data found, run seed.py first")
+    return {"users": users, "received": received}
+
+class QueryCounter:
+    """
+    Statements executed on the database according to pg_stat_statements
+    (None if the extension is not available).
+    """
+
+    def __init__(self, database_url):
+        self.connection = ps.connect(database_url)
+        self.connection.autocommit = True
+        try:
+            with self.connection.cursor() as cur:
+                cur.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;")
+                cur.execute("SELECT count(*) FROM pg_stat_statements;")
+            self.available = True
+        except ps.Error as e:
+            print("pg_stat_statements not available, queries are not counted (%s)"
+                % str(e).strip())
+            self.available = False
+
+    def count(self):
+        if not self.available:
+            return None
+        with self.connection.cursor() as cur:
+            cur.execute(
+                '''
+                SELECT COALESCE(sum(calls), 0) FROM pg_stat_statements
+                WHERE dbid = (SELECT oid FROM pg_database
+                              WHERE datname = current_database());''')
+            return int(cur.fetchone()[0])
+
+    def close(self):
+        self.connection.close()
+
+def run_mixed(url, data, mix, concurrency, duration, prefix, seed):
+    """
+    Run the weighted mix of operations from concurrency threads for duration
+    seconds, return the (operation, latency, status) samples.
+    """
+    operations = [op for op, weight in mix.items() if weight > 0]
+    weights = [mix[op] for op in operations]
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def _run(thread_id):
+        rng = random.Random(seed + thread_id)
+        client = Client(url)
+        scenarios = Scenarios(client, data, rng, prefix)
+        local = []
+        while time.monotonic() < deadline:
+            op = rng.choices(operations, weights)[0]
+            local.append(_timed(client, scenarios, op))
+        client.close()
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=_run, args=(i,)) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples
+
+def run_profile(url, data, operations, counter, requests, prefix, seed):
+    """
+    Run each operation alone and sequentially, return the number of database
+    statements per request of each operation.
+    """
+    rng = random.Random(seed)
+    client = Client(url)
+    scenarios = Scenarios(client, data, rng, prefix)
+    queries = {}
+    for op in operations:
+        total = 0
+        for _ in range(requests):
+            # the setup requests are not counted
+            request = getattr(scenarios, op)()
+            before = counter.count()
+            try:
+                client.send(request)
+            except (OSError, http.client.HTTPException):
+                pass
+            total += counter.count() - before - 1 # the count() query itself
+        queries[op] = total / requests
+    client.close()
+    return queries
+
+def _timed(client, scenarios, op):
+    try:
+        request = getattr(scenarios, op)()
+    except Exception as e:
+        return (op, None, "setup: %s" % e)
+    start = time.perf_counter()
+    try:
+        status, _ = client.send(request)
+    except (OSError, http.client.HTTPException) as e:
+        return (op, time.perf_counter() - start, type(e).__name__)
+    return (op, time.perf_counter() - start, status)
+
+def percentile(values, p):
+    # nearest-rank percentile of sorted values
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[rank]
+
+def summarize(samples, duration):
+    """
+    Latency percentiles (milliseconds), throughput and errors per operation.
+    """
+    by_op = collections.defaultdict(list)
+    for op, latency, status in samples:
+        by_op[op].append((latency, status))
+
+    operations = {}
+    for op, results in sorted(by_op.items()):
+        latencies = sorted(l * 1000 for l, s in results
+            if l is not None and isinstance(s, int) and s < 400)
+        errors = collections.Counter(str(s) for _, s in results
+            if not (isinstance(s, int) and s < 400))
+        operations[op] = {
+            "requests": len(results),
+            "throughput": len(results) / duration,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "errors": dict(errors),
+        }
+    return operations
+
+def save(results, directory=RESULTS_DIR):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%s.json" %
+        datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ"))
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return path
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    mix = dict(DEFAULT_MIX)
+    for item in args.mix:
+        op, _, weight = item.partition("=")
+        mix[op] = float(weight)
+
+    uncovered = [op for op in operation_ids() if not hasattr(Scenarios, op)]
+    if uncovered:
+        print("WARNING: no scenario for %s" % ", ".join(uncovered))
+    unknown = [op for op in mix if not hasattr(Scenarios, op)]
+    if unknown:
+        raise SystemExit("Unknown operations in the mix: %s" % ", ".join(unknown))
+
+    data = load_data(args.database_url, args.prefix)
+    counter = QueryCounter(args.database_url)
+    try:
+        print("Running the mixed load: %d threads for %ds" %
+            (args.concurrency, args.duration))
+        queries_before = counter.count()
+        samples = run_mixed(args.url, data, mix, args.concurrency,
+            args.duration, args.prefix, args.seed)
+        queries = (None if queries_before is None else
+            counter.count() - queries_before - 1)
+
+        operations = summarize(samples, args.duration)
+        if args.profile_requests > 0 and counter.available:
+            print("Counting the queries of each operation")
+            profile = run_profile(args.url, data, sorted(operations), counter,
+                args.profile_requests, args.prefix, args.seed)
+            for op, per_request in profile.items():
+                operations[op]["queries_per_request"] = per_request
+    finally:
+        counter.close()
+
+    results = {
+        "commit": _git_commit(),
+        "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "config": {
+            "url": args.url,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": mix,
+            "users": len(data["users"]),
+        },
+        "requests": len(samples),
+        "throughput": len(samples) / args.duration,
+        "queries_per_request": (None if queries is None or not samples
+            else queries / len(samples)),
+        "operations": operations,
+        "uncovered": uncovered,
+    }
+
+    print("%-24s %8s %9s %8s %8s %8s %8s %6s" %
+        ("operation", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries", "errors"))
+    for op, r in operations.items():
+        print("%-24s %8d %9.1f %8s %8s %8s %8s %6d" % (
+            op, r["requests"], r["throughput"],
+            _fmt(r["p50"]), _fmt(r["p95"]), _fmt(r["p99"]),
+            _fmt(r.get("queries_per_request")), sum(r["errors"].values())))
+    print("total: %d requests, %.1f req/s, %s queries per request" % (
+        results["requests"], results["throughput"],
+        _fmt(results["queries_per_request"])))
+    print("Results saved to %s" % save(results))
+
+def _fmt(value):
+    return "-" if value is None else "%.2f" % value
+
+
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a load test against the API")
+    parser.add_argument("database_url", nargs="?", default=db_utils.DEFAULT_DB)
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--mix", action="append", default=[],
+        metavar="OPERATION=WEIGHT", help="change the weight of an operation")
+    parser.add_argument("--profile-requests", type=int, default=20,
+        help="requests per operation when counting the queries, 0 to skip")
+    parser.add_argument("--prefix", default="bench_")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
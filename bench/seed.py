@@ -0,0 +1,167 @@
+import argparse
+import datetime
+import io
+import os
+import random
+import sys
+
+import psycopg2 as ps
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+import db_utils
+
+# Synthetic data for the benchmarks, loaded with COPY on top of a migrated
+# database (see db_init.py). The users are named <prefix><n> with their
+# username as password, the counters (Mailboxes, Outboxes) are maintained by
+# the triggers as with the API.
+
+def seed(
+    database_url,
+    users=1000,
+    messages=100000,
+    fanout=3,
+    broadcast_ratio=0.001,
+    read_ratio=0.5,
+    prefix="bench_",
+    days=30,
+    seed=0,
+    batch_size=50000):
+
+    """
+    Insert the users and the messages, each message has between 1 and fanout
+    receivers unless it is a broadcast. Return the number of rows per table.
+    """
+    rng = random.Random(seed)
+    conn = ps.connect(database_url)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(user_id), 0) FROM Users;")
+        first_user = cur.fetchone()[0] + 1
+        cur.execute("SELECT COALESCE(MAX(message_id), 0) FROM Messages;")
+        first_message = cur.fetchone()[0] + 1
+
+        # the users are older than the messages, so that all the broadcasts
+        # are in their inbox
+        user_ids = range(first_user, first_user + users)
+        start = (datetime.datetime.now(datetime.timezone.utc) -
+            datetime.timedelta(days=days))
+        _copy(cur, "Users", ["user_id", "username", "password", "created_at"], (
+            (user_id, prefix + str(user_id), prefix + str(user_id),
+                start - datetime.timedelta(days=1))
+            for user_id in user_ids))
+        # monthly partitions of the messages (see migrations.py)
+        cur.execute("SELECT create_message_partitions(%s, current_date);",
+            [start.date()])
+        conn.commit()
+
+        counts = {"users": users, "messages": 0, "receivers": 0}
+        step = datetime.timedelta(days=days) / max(messages, 1)
+        for offset in range(0, messages, batch_size):
+            batch = []
+            texts = []
+            receivers = []
+            for message_id in range(
+                first_message + offset,
+                first_message + min(offset + batch_size, messages)):
+
+                sender_id = rng.choice(user_ids)
+                timestamp = start + step * (message_id - first_message)
+                broadcast = rng.random() < broadcast_ratio
+                texts.append(_text(rng))
+                batch.append((message_id, sender_id, timestamp, broadcast))
+                if broadcast:
+                    continue
+                for receiver_id in set(rng.choice(user_ids)
+                    for _ in range(rng.randint(1, fanout))):
+                    receivers.append(
+                        (message_id, receiver_id, rng.random() < read_ratio, timestamp))
+
+            # the bodies may already be stored by a previous run
+            body_rows, body_hashes = db_utils._bodies(texts)
+            ps.extras.execute_values(
+                cur,
+                db_utils._INSERT_BODIES_SQL,
+                body_rows,
+                template=db_utils._INSERT_BODIES_TEMPLATE,
+                page_size=1000)
+            _copy(cur, "Messages",
+                ["message_id", "sender_id", "body_hash", "timestamp", "broadcast"],
+                ((message_id, sender_id, body_hash, timestamp, broadcast)
+                    for (message_id, sender_id, timestamp, broadcast), body_hash
+                    in zip(batch, body_hashes)))
+            _copy(cur, "Receivers",
+                ["message_id", "receiver_id", "message_read", "timestamp"],
+                receivers)
+            conn.commit()
+            counts["messages"] += len(batch)
+            counts["receivers"] += len(receivers)
+
+        # the ids were given explicitly
+        cur.execute(
+            "SELECT setval(pg_get_serial_sequence('Users', 'user_id'), MAX(user_id)) FROM Users;")
+        cur.execute(
+            "SELECT setval(pg_get_serial_sequence('Messages', 'message_id'), MAX(message_id)) FROM Messages;")
+        conn.commit()
+        cur.execute("ANALYZE;")
+        conn.commit()
+        cur.close()
+        return counts
+    finally:
+        conn.close()
+
+_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+    "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+def _text(rng):
+    return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 40)))
+
+def _copy(cursor, table, columns, rows):
+    # rows are written in the text format of COPY
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(v) for v in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(
+        "COPY %s (%s) FROM STDIN;" % (table, ", ".join(columns)), buffer)
+
+def _copy_value(value):
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bytes): # bytea in hex, with the escaped backslash
+        return "\\\\x" + value.hex()
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+        .replace("\n", "\\n"))
+
+
+#===============================================================================
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seed the database with synthetic data")
+    parser.add_argument("database_url", nargs="?", default=db_utils.DEFAULT_DB)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--fanout", type=int, default=3,
+        help="maximum number of receivers per message")
+    parser.add_argument("--broadcast-ratio", type=float, default=0.001)
+    parser.add_argument("--read-ratio", type=float, default=0.5)
+    parser.add_argument("--prefix", default="bench_")
+    parser.add_argument("--days", type=int, default=30,
+        help="time span of the messages, ending now")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    counts = seed(
+        args.database_url,
+        users=args.users,
+        messages=args.messages,
+        fanout=args.fanout,
+        broadcast_ratio=args.broadcast_ratio,
+        read_ratio=args.read_ratio,
+        prefix=args.prefix,
+        days=args.days,
+        seed=args.seed)
+    print("Inserted %(users)d users, %(messages)d messages and "
+          "%(receivers)d receivers" % counts)
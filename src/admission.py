@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import contextlib
+import math
+import threading
+import time
+
+import exceptions
+
+# Admission control of the API operations, applied by controller.resolve (and
+# async_controller.resolve) before an operation runs. Every user has a token
+# bucket per operation, refilled at the rate of the operation up to its burst,
+# so that the expensive operations (e.g. broadcast_message) have lower limits.
+# Only the users whose credentials are cached (i.e. verified) are rate limited,
+# so that requests with wrong passwords cannot drain the bucket of a user. The
+# buckets are kept by each process: with several worker processes (gunicorn),
+# a user whose requests reach all of them gets up to that many times the
+# limits, while one keeping its connection to a worker gets them exactly. The
+# operations running at the same time
+# are limited, by default to the size of the connection pool (or to the
+# threads of the worker if fewer), a request waits a short time for a slot and
+# is turned down with a 503 instead of queuing for a database connection.
+
+# operations never limited: the metrics scrapes and the long-lived event streams
+EXEMPT = frozenset(["get_metrics", "stream_messages"])
+
+# (requests per second, burst) by operation id, "default" for the others (no
+# limit without it); a rate of 0 disables the limit
+DEFAULT_LIMITS = {
+    "default": (20.0, 40),
+    "add_user": (1.0, 5),
+    "update_user": (1.0, 5),
+    "send_message": (5.0, 10),
+    "send_messages": (1.0, 3),
+    "broadcast_message": (0.1, 1),
+    "search_messages": (2.0, 5),
+}
+
+def parse_limits(spec:str) -> dict:
+    """
+    Parse limits given as "operation=rate/burst,..." (e.g. the RATE_LIMITS
+    environment variable) into a dict of the DEFAULT_LIMITS form, which they
+    replace.
+    """
+    limits = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        try:
+            operation, _, limit = item.partition("=")
+            rate, _, burst = limit.partition("/")
+            limits[operation.strip()] = (float(rate), int(burst or 1))
+        except ValueError:
+            raise ValueError("Invalid rate limit %r, expected operation=rate/burst"
+                % item)
+    return limits
+
+class RateLimiter:
+    """
+    Token buckets of the users by operation (with DEFAULT_LIMITS unless other
+    limits are given), the least recently used ones are dropped beyond
+    max_size (a dropped bucket is full again).
+    """
+
+    def __init__(self, limits:dict=None, max_size:int=100000):
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.max_size = max_size
+
+        self._buckets = collections.OrderedDict() # (user_id, operation) -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def admit(self, user_id:int, operation:str):
+        """
+        Take a token from the bucket of the user for the operation, raise
+        TooManyRequestsException (with the seconds until the next token) if
+        it is empty.
+        """
+        rate, burst = self.limits.get(operation, self.limits.get("default", (0, 0)))
+        if rate <= 0:
+            return
+        key = (user_id, operation)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            admitted = tokens >= 1
+            self._buckets[key] = (tokens - 1 if admitted else tokens, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        if not admitted:
+            raise exceptions.TooManyRequestsException(
+                "Rate limit of %s exceeded, retry later" % operation,
+                retry_after=math.ceil((1 - tokens) / rate))
+
+class ConcurrencyLimiter:
+    """
+    Limit of the operations running at the same time in the threads of the
+    process, None for no limit.
+    """
+
+    def __init__(self, max_concurrent:int=None, timeout:float=0.1):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self._semaphore = (None if not max_concurrent else
+            threading.BoundedSemaphore(max_concurrent))
+
+    def acquire(self):
+        """
+        Take a slot, waiting at most `timeout` seconds for one before raising
+        ServiceUnavailableException.
+        """
+        if self._semaphore is None:
+            return
+        if not self._semaphore.acquire(timeout=self.timeout):
+            raise exceptions.ServiceUnavailableException(
+                "Too many concurrent requests, retry later")
+
+    def release(self):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Hold a slot for the duration of the block, see acquire.
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+class AsyncConcurrencyLimiter:
+    """
+    ConcurrencyLimiter of the coroutines of an event loop, to be created
+    within the loop.
+    """
+
+    def __init__(self, max_concurrent:int=None, timeout:float=0.1):
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self._semaphore = (None if not max_concurrent else
+            asyncio.BoundedSemaphore(max_concurrent))
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        if self._semaphore is None:
+            yield
+            return
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise exceptions.ServiceUnavailableException(
+                "Too many concurrent requests, retry later")
+        try:
+            yield
+        finally:
+            self._semaphore.release()
@@ -0,0 +1,748 @@
+import asyncio
+import base64
+import binascii
+import contextlib
+import datetime
+import functools
+import itertools
+import json
+import logging
+import time
+
+import aiopg
+import psycopg2 as ps
+from aiohttp import web
+
+import admission
+import async_db_utils
+import auth_cache
+import bodies
+import db_utils
+import exceptions
+import metrics
+import serializer
+import subscriptions
+
+# asyncio counterpart of controller, serving the same swagger.yml operations
+# (resolved by name through resolve) on aiohttp with an aiopg pool. The
+# handlers receive the aiohttp request as the `request` argument.
+
+logger = logging.getLogger(__name__)
+
+pool = None
+pool_timeout = 5.0
+replica_pools = []
+credentials_cache = auth_cache.CredentialCache()
+rate_limiter = admission.RateLimiter()
+concurrency_limiter = admission.AsyncConcurrencyLimiter()
+new_messages = subscriptions.Subscriptions(queue_class=asyncio.Queue)
+
+# seconds between two keep-alive comments on an idle event stream
+STREAM_KEEPALIVE = 15.0
+
+# see controller.SESSION_LSN_HEADER
+SESSION_LSN_HEADER = "X-Session-LSN"
+
+_next_replica = itertools.count()
+
+def resolve(operation_id):
+    """
+    Map the controller.<name> operation ids of swagger.yml to this module,
+    behind the admission control and instrumented by metrics.
+    """
+    name = operation_id.rpartition('.')[2]
+    return metrics.instrument(name)(_admitted(name, globals()[name]))
+
+def _admitted(operation, f):
+    # see controller._admitted
+    if operation in admission.EXEMPT:
+        return f
+
+    @functools.wraps(f)
+    async def wrapper(*args, **kwargs):
+        try:
+            credentials = _basic_auth(kwargs["request"])
+        except exceptions.UnauthorizedException:
+            credentials = None # answered by the operation
+        try:
+            if credentials is not None:
+                user_id = credentials_cache.peek(*credentials)
+                if user_id is not None:
+                    rate_limiter.admit(user_id, operation)
+            async with concurrency_limiter.slot():
+                return await f(*args, **kwargs)
+        except (exceptions.TooManyRequestsException,
+                exceptions.ServiceUnavailableException) as e:
+            return _response(e.description, e.code, e.retry_after_header)
+    return wrapper
+
+def setup(
+    app:web.Application,
+    db_url,
+    min_size=1,
+    max_size=10,
+    timeout=5.0,
+    auth_cache_size=10000,
+    auth_cache_ttl=60.0,
+    slow_query_ms=1000,
+    body_compress_min_size=256,
+    replica_urls=(),
+    rate_limits=None,
+    max_concurrent=None,
+    admission_timeout=0.1):
+
+    """
+    Register the creation of the pools and of the listener on the startup of
+    the aiohttp application, and their disposal on its cleanup.
+    """
+    global credentials_cache
+    global rate_limiter
+    credentials_cache = auth_cache.CredentialCache(
+        max_size=auth_cache_size,
+        ttl=auth_cache_ttl)
+    metrics.collect_auth_cache(credentials_cache)
+    rate_limiter = admission.RateLimiter(rate_limits)
+    metrics.slow_query_seconds = slow_query_ms / 1000.0 if slow_query_ms else None
+    bodies.compress_min_size = body_compress_min_size or None
+
+    async def on_startup(app):
+        global pool
+        global pool_timeout
+        global concurrency_limiter
+        concurrency_limiter = admission.AsyncConcurrencyLimiter(
+            max_size if max_concurrent is None else max_concurrent,
+            admission_timeout)
+        pool = await aiopg.create_pool(db_url, minsize=min_size, maxsize=max_size)
+        pool_timeout = timeout
+        for url in replica_urls:
+            replica_pools.append(
+                await aiopg.create_pool(url, minsize=0, maxsize=max_size))
+        metrics.POOL_CONNECTIONS.collect = lambda: {
+            ("open",): pool.size, ("idle",): pool.freesize, ("max",): pool.maxsize}
+        app["listener"] = asyncio.ensure_future(_listen(db_url))
+
+    async def on_cleanup(app):
+        app["listener"].cancel()
+        for p in [pool] + replica_pools:
+            p.close()
+            await p.wait_closed()
+
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.on_response_prepare.append(_add_session_lsn)
+
+@contextlib.asynccontextmanager
+async def get_cursor(request=None):
+    """
+    Check a connection out of the pool for the duration of the block. With
+    replicas, the session token of the request is set when the block ends.
+    """
+    start = time.perf_counter()
+    try:
+        connection = await asyncio.wait_for(pool.acquire(), pool_timeout)
+    except asyncio.TimeoutError:
+        raise exceptions.ServiceUnavailableException(
+            "No database connection available, retry later")
+    finally:
+        metrics.POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+    try:
+        async with connection.cursor() as cur:
+            yield metrics.InstrumentedAsyncCursor(cur)
+            if replica_pools and request is not None:
+                request["session_lsn"] = await async_db_utils.get_wal_lsn(cur)
+    finally:
+        pool.release(connection)
+
+@contextlib.asynccontextmanager
+async def get_read_cursor(request):
+    """
+    Check out for the duration of the block a connection for a read-only
+    operation, see controller.get_read_connection.
+    """
+    replica_pool, connection = await _replica_connection(
+        request.headers.get(SESSION_LSN_HEADER))
+    if connection is None:
+        async with get_cursor(request) as cur:
+            yield cur
+        return
+    try:
+        async with connection.cursor() as cur:
+            yield metrics.InstrumentedAsyncCursor(cur)
+    finally:
+        replica_pool.release(connection)
+
+async def _replica_connection(lsn):
+    # see controller._replica_connection
+    if not replica_pools or (lsn is not None and not db_utils.is_lsn(lsn)):
+        if replica_pools:
+            metrics.READ_ROUTING.inc(("primary",))
+        return None, None
+
+    start = next(_next_replica)
+    for i in range(len(replica_pools)):
+        replica_pool = replica_pools[(start + i) % len(replica_pools)]
+        try:
+            connection = await asyncio.wait_for(replica_pool.acquire(), pool_timeout)
+        except (asyncio.TimeoutError, ps.Error):
+            continue
+        try:
+            if lsn is None:
+                replayed = True
+            else:
+                async with connection.cursor() as cur:
+                    replayed = await async_db_utils.has_replayed(cur, lsn)
+        except ps.Error:
+            replica_pool.release(connection)
+            continue
+        if replayed:
+            metrics.READ_ROUTING.inc(("replica",))
+            return replica_pool, connection
+        replica_pool.release(connection)
+
+    # lagging or unavailable replicas
+    metrics.READ_ROUTING.inc(("primary",))
+    return None, None
+
+async def _add_session_lsn(request, response):
+    # see controller.add_session_lsn
+    if "session_lsn" in request:
+        response.headers[SESSION_LSN_HEADER] = request["session_lsn"]
+
+#metrics -----------------------------------------------------------------------
+async def get_metrics(request):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+#users/ ------------------------------------------------------------------------
+async def add_user(user_info, request):
+    try:
+        async with get_cursor(request) as cur:
+            await _check_credentials(request, cur)
+
+            new_user_id = await async_db_utils.add_user(
+                cursor=cur,
+                username=user_info["username"],
+                password=user_info["password"])
+            return _response(new_user_id, 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+async def get_all_users(request, limit=None, after=None, stream=False, ids=None,
+    usernames=None):
+    try:
+        await _check_credentials(request)
+        async with get_read_cursor(request) as cur:
+            after_user_id = (None if after is None else
+                db_utils.decode_cursor(after, [int])[0])
+
+            etag = db_utils.make_etag(
+                "users", await async_db_utils.get_version(cur, "users"),
+                limit, after, stream, ids, usernames)
+            if db_utils.etag_matches(request.headers.get("If-None-Match"), etag):
+                return _not_modified(etag)
+
+            if stream:
+                chunks = async_db_utils.iter_users(
+                    cur, after_user_id=after_user_id, limit=limit,
+                    user_ids=ids, usernames=usernames)
+                return await _stream_response(request, chunks, etag)
+
+            users = await async_db_utils.list_users(
+                cur,
+                after_user_id=after_user_id,
+                limit=None if limit is None else limit + 1,
+                user_ids=ids,
+                usernames=usernames)
+            return _page(users, limit, ["user_id"], etag)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# users/{user_id} --------------------------------------------------------------
+async def send_message(message, request, deferred=False):
+    try:
+        async with get_cursor(request) as cur:
+            sender_id = await _check_credentials(request, cur)
+
+            if deferred:
+                job_id, msg_id = await async_db_utils.enqueue_message(
+                    cursor=cur,
+                    receiver_ids=message["receiver_ids"],
+                    sender_id=sender_id,
+                    msg_text=message["message_text"])
+                return _response({"job_id": job_id, "message_id": msg_id}, 202)
+
+            msg_id = await async_db_utils.send_message(
+                cursor=cur,
+                receiver_ids=message["receiver_ids"],
+                sender_id=sender_id,
+                msg_text=message["message_text"])
+            return _response(msg_id, 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+async def send_messages(messages, request):
+    try:
+        async with get_cursor(request) as cur:
+            sender_id = await _check_credentials(request, cur)
+
+            message_ids = await async_db_utils.send_messages(
+                cursor=cur,
+                sender_id=sender_id,
+                messages=[(m["receiver_ids"], m["message_text"]) for m in messages])
+            return _response(message_ids, 201)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+async def update_user(user_id, user_info, request):
+    try:
+        async with get_cursor(request) as cur:
+            authorized_user_id = await _check_credentials(request, cur)
+            if authorized_user_id != user_id:
+                raise exceptions.UnauthorizedException(
+                    "Not enough rights to change the given user's info")
+
+            result = await async_db_utils.update_user(
+                cursor=cur,
+                user_id=user_id,
+                new_username=user_info["username"],
+                new_password=user_info["password"])
+            credentials_cache.invalidate_user(user_id)
+            return _response(result, 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+async def get_user(user_id, request):
+    return await _get_user(
+        request, "Given user-id not found", True, where_user_id=user_id)
+
+async def get_user_v2(username, request):
+    return await _get_user(
+        request, "Given username not found", False, where_username=username)
+
+async def _get_user(request, not_found, conditional, **where):
+    try:
+        await _check_credentials(request)
+        async with get_read_cursor(request) as cur:
+            headers = None
+            if conditional:
+                etag = db_utils.make_etag(
+                    "user", await async_db_utils.get_version(cur, "users"),
+                    *where.values())
+                if db_utils.etag_matches(request.headers.get("If-None-Match"), etag):
+                    return _not_modified(etag)
+                headers = _etag_header(etag)
+
+            results = await async_db_utils.query_users(
+                cur, select_username=True, select_user_id=True, **where)
+            if len(results) == 0:
+                raise exceptions.NotFoundException(not_found)
+            return _response(results[0], 200, headers)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# users/all --------------------------------------------------------------------
+async def broadcast_message(message, request):
+    try:
+        async with get_cursor(request) as cur:
+            user_id = await _check_credentials(request, cur)
+            message_text = (message.decode('utf-8')
+                if isinstance(message, bytes) else message)
+
+            message_id = await async_db_utils.broadcast_message(
+                cur, user_id, message_text)
+            return _response(message_id, 201)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# user/{user_id}/received and user/{user_id}/sent ------------------------------
+async def get_received_messages(user_id, request, limit=None, after=None, stream=False,
+    unread=False, sender_username=False):
+    return await _get_messages(
+        request, user_id, limit, after, stream, "received",
+        async_db_utils.get_received_messages,
+        async_db_utils.iter_received_messages,
+        unread=unread, sender_username=sender_username)
+
+async def get_sent_messages(user_id, request, limit=None, after=None, stream=False):
+    return await _get_messages(
+        request, user_id, limit, after, stream, "sent",
+        async_db_utils.get_sent_messages,
+        async_db_utils.iter_sent_messages)
+
+async def _get_messages(request, user_id, limit, after, stream, listing, fetch, iterate,
+    **filters):
+    # the filters are passed on to fetch and iterate
+    try:
+        authorized_user_id = await _check_credentials(request)
+        if authorized_user_id != user_id:
+            raise exceptions.UnauthorizedException(
+                "Not enough rights to access the user's messages!")
+        async with get_read_cursor(request) as cur:
+            after_key = None if after is None else db_utils.decode_cursor(after, [str, int])
+
+            # see controller.get_received_messages
+            versions = await async_db_utils.get_version(cur, listing, user_id)
+            if filters.get("sender_username"):
+                versions += await async_db_utils.get_version(cur, "users")
+            etag = db_utils.make_etag(
+                listing, user_id, versions, limit, after, stream, *filters.values())
+            if db_utils.etag_matches(request.headers.get("If-None-Match"), etag):
+                return _not_modified(etag)
+
+            if stream:
+                return await _stream_response(
+                    request, iterate(cur, user_id, limit, after_key, **filters), etag)
+
+            messages = await fetch(
+                cur, user_id, None if limit is None else limit + 1, after_key, **filters)
+            return _page(messages, limit, ["timestamp", "message_id"], etag)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+async def mark_read(user_id, selection, request):
+    try:
+        async with get_cursor(request) as cur:
+            authorized_user_id = await _check_credentials(request, cur)
+            if authorized_user_id != user_id:
+                raise exceptions.UnauthorizedException(
+                    "Not enough rights to access the user's received messages!")
+
+            marked = await async_db_utils.mark_read(
+                cursor=cur,
+                user_id=user_id,
+                message_ids=selection.get("message_ids"),
+                before=selection.get("before"))
+            return _response({"marked": marked}, 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# user/{user_id}/search --------------------------------------------------------
+async def search_messages(user_id, q, request, limit=None, after=None):
+    try:
+        authorized_user_id = await _check_credentials(request)
+        if authorized_user_id != user_id:
+            raise exceptions.UnauthorizedException(
+                "Not enough rights to search the user's messages!")
+        async with get_read_cursor(request) as cur:
+            after_key = None if after is None else db_utils.decode_cursor(after, [float, int])
+
+            messages = await async_db_utils.search_messages(
+                cur, user_id, q, None if limit is None else limit + 1, after_key)
+            return _page(messages, limit, ["rank", "message_id"])
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# user/{user_id}/unread --------------------------------------------------------
+async def get_unread_count(user_id, request):
+    try:
+        async with get_cursor(request) as cur:
+            authorized_user_id = await _check_credentials(request, cur)
+            if authorized_user_id != user_id:
+                raise exceptions.UnauthorizedException(
+                    "Not enough rights to access the user's received messages!")
+
+            unread = await async_db_utils.get_unread_count(cur, user_id)
+            return _response({"unread": unread}, 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# user/{user_id}/stream --------------------------------------------------------
+async def stream_messages(user_id, request):
+    try:
+        # an idle stream must not keep a database connection
+        async with get_cursor(request) as cur:
+            authorized_user_id = await _check_credentials(request, cur)
+            if authorized_user_id != user_id:
+                raise exceptions.UnauthorizedException(
+                    "Not enough rights to access the user's received messages!")
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+    events = new_messages.subscribe(user_id)
+    try:
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"})
+        await response.prepare(request)
+        await response.write(b"retry: 3000\n\n")
+        while True:
+            try:
+                event, data = await asyncio.wait_for(events.get(), STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keep-alive\n\n")
+                continue
+            await response.write(
+                ("event: %s\ndata: %s\n\n" % (event, json.dumps(data))).encode())
+    finally:
+        new_messages.unsubscribe(user_id, events)
+
+# message/{msg_id} -------------------------------------------------------------
+async def get_message(message_id, request):
+    try:
+        async with get_cursor(request) as cur:
+            user_id = await _check_credentials(request, cur)
+
+            # see controller.get_message
+            if_none_match = request.headers.get("If-None-Match")
+            if if_none_match is not None:
+                version = await async_db_utils.get_message_version(
+                    cur, user_id, message_id)
+                etag = db_utils.make_etag("message", message_id, version)
+                if db_utils.etag_matches(if_none_match, etag):
+                    return _not_modified(etag)
+
+            result = await async_db_utils.get_message(
+                cursor=cur,
+                user_id=user_id,
+                message_id=message_id)
+            etag = db_utils.make_etag(
+                "message", message_id, db_utils.message_version(result))
+            return _response(result, 200, _etag_header(etag))
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+async def delete_message(message_id, request):
+    try:
+        async with get_cursor(request) as cur:
+            user_id = await _check_credentials(request, cur)
+            await async_db_utils.delete_message(
+                cursor=cur,
+                user_id=user_id,
+                message_id=message_id)
+            return _response("Message successfully delated", 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+# jobs/{job_id} -----------------------------------------------------------------
+async def get_job(job_id, request):
+    try:
+        async with get_cursor(request) as cur:
+            user_id = await _check_credentials(request, cur)
+
+            job = await async_db_utils.get_job(cur, job_id)
+            if job["sender_id"] != user_id:
+                raise exceptions.UnauthorizedException(
+                    "Only the sender user can follow the delivery of the message")
+            return _response(job, 200)
+
+    except exceptions.UnauthorizedException as e:
+        return _response(e.description, e.code, e.authentication_header)
+    except exceptions.ServiceUnavailableException as e:
+        return _response(e.description, e.code, e.retry_after_header)
+    except exceptions.ResponseException as e:
+        return _response(e.description, e.code)
+
+#-------------------------------------------------------------------------------
+################################################################################
+
+def _basic_auth(request):
+    # (username, password) of the Basic HTTP authentication, None without it
+    header = request.headers.get('Authorization', '').split()
+    if len(header) != 2 or header[0] != "Basic":
+        return None
+    try:
+        username, _, password = (
+            base64.b64decode(header[1]).decode('utf-8').partition(':'))
+    except (ValueError, binascii.Error):
+        raise exceptions.UnauthorizedException(
+            "Invalid authentication credentials!")
+    return username, password
+
+@metrics.AUTH_SECONDS.time()
+async def _check_credentials(request, cursor=None):
+    # check that the authorization method is Basic HTTP
+    credentials = _basic_auth(request)
+    if credentials is None:
+        raise exceptions.UnauthorizedException(
+            "You must use Basic HTTP authentication to access this resource")
+    username, password = credentials
+
+    # recently verified credentials don't need a database round trip
+    user_id = credentials_cache.get(username, password)
+    if user_id is not None:
+        return user_id
+    generation = credentials_cache.generation()
+
+    # without a cursor (the read-only operations), the primary is queried as
+    # by controller._check_credentials, before the read cursor is checked out
+    # so that a request never holds two connections of the primary pool
+    if cursor is None:
+        async with get_cursor() as cur:
+            user_ids = await async_db_utils.query_users(
+                cur,
+                where_username=username,
+                where_password=password,
+                select_user_id=True)
+    else:
+        user_ids = await async_db_utils.query_users(
+            cursor,
+            where_username=username,
+            where_password=password,
+            select_user_id=True)
+    if len(user_ids) == 0:
+        raise exceptions.UnauthorizedException(
+            "Invalid authentication credentials!")
+
+    user_id = user_ids[0]["user_id"]
+    credentials_cache.put(username, password, user_id, generation)
+    return user_id
+
+async def _listen(db_url, reconnect_delay=1.0):
+    # asyncio counterpart of db_listener.Listener for the two channels in use
+    first_connection = True
+    while True:
+        try:
+            async with aiopg.connect(db_url) as connection:
+                async with connection.cursor() as cur:
+                    await cur.execute("LISTEN " + db_utils.CREDENTIALS_CHANNEL + ";")
+                    await cur.execute("LISTEN " + db_utils.NEW_MESSAGE_CHANNEL + ";")
+                if not first_connection:
+                    credentials_cache.clear()
+                    new_messages.resync()
+                first_connection = False
+
+                while True:
+                    notify = await connection.notifies.get()
+                    try:
+                        if notify.channel == db_utils.CREDENTIALS_CHANNEL:
+                            credentials_cache.invalidate_user(int(notify.payload))
+                        else:
+                            new_messages.publish(notify.payload)
+                    except Exception:
+                        logger.exception(
+                            "Notification on %s failed", notify.channel)
+        except (OSError, ps.Error):
+            first_connection = False
+            await asyncio.sleep(reconnect_delay)
+
+def _json_default(o):
+    # same date-time format as the connexion JSON encoder of the sync mode
+    if isinstance(o, datetime.datetime):
+        return o.isoformat() if o.tzinfo else o.isoformat() + "Z"
+    raise TypeError(repr(o))
+
+def _response(body, status, headers=None):
+    return web.Response(
+        text=json.dumps(body, default=_json_default),
+        status=status,
+        headers=headers,
+        content_type="application/json")
+
+def _page(rows, limit, keyset, etag=None):
+    # see controller._page
+    headers = {} if etag is None else _etag_header(etag)
+    if limit is not None and len(rows) > limit:
+        del rows[limit:]
+        headers["X-Next-Cursor"] = db_utils.encode_cursor(
+            [rows.last(k) for k in keyset])
+    return web.Response(
+        body=serializer.dumps(rows),
+        headers=headers,
+        content_type="application/json")
+
+def _etag_header(etag):
+    return {"ETag": '"%s"' % etag}
+
+def _not_modified(etag):
+    return web.Response(status=304, headers=_etag_header(etag))
+
+async def _stream_response(request, chunks, etag=None):
+    """
+    Stream the chunks of rows of an async_db_utils.iter_* generator as a JSON
+    array. The first chunk is fetched before the response is started so that
+    query errors can still be answered with a proper status code.
+    """
+    try:
+        rows = await chunks.__anext__()
+    except StopAsyncIteration:
+        rows = None
+
+    headers = {"Content-Type": "application/json"}
+    if etag is not None:
+        headers.update(_etag_header(etag))
+    response = web.StreamResponse(headers=headers)
+    await response.prepare(request)
+    await response.write(b"[")
+    separator = ""
+    while rows is not None:
+        encode = serializer.row_encoder(rows.description)
+        await response.write(
+            (separator + ",".join([encode(row) for row in rows])).encode())
+        separator = ","
+        try:
+            rows = await chunks.__anext__()
+        except StopAsyncIteration:
+            rows = None
+    await response.write(b"]")
+    await response.write_eof()
+    return response
@@ -0,0 +1,419 @@
+import contextlib
+import functools
+
+import psycopg2 as ps
+import psycopg2.errorcodes as errorcodes
+
+import db_utils
+import exceptions
+import prepared
+import serializer
+
+# asyncio counterpart of db_utils used by the async serving mode, the cursors
+# are aiopg cursors. aiopg connections are always in autocommit mode so the
+# transactions are opened explicitly, and the SQL is shared with db_utils
+# wherever a statement is more than a one-liner.
+
+@contextlib.asynccontextmanager
+async def transaction(cursor):
+    await cursor.execute("BEGIN;")
+    try:
+        yield
+    except BaseException:
+        await cursor.execute("ROLLBACK;")
+        raise
+    else:
+        await cursor.execute("COMMIT;")
+
+#-------------------------------------------------------------------------------
+async def add_user(cursor, username:str, password:str):
+    db_utils._check_username(username)
+
+    # insert new user into the database
+    try:
+        async with transaction(cursor):
+            await cursor.execute(
+                "INSERT INTO Users (username, password) VALUES (%s, %s) RETURNING user_id;",
+                [username, password])
+            result = await cursor.fetchone()
+        return result[0]
+
+    except ps.DataError as e:
+        if e.pgcode == errorcodes.STRING_DATA_RIGHT_TRUNCATION:
+            raise exceptions.BadRequestException(
+                '''Invalid username, it must contain alphanumeric
+                characters or \'-\' or \'_\'''')
+        else:
+            raise exceptions.BadRequestException(e.pgerror)
+
+    except ps.IntegrityError as e:
+        if e.pgcode == errorcodes.UNIQUE_VIOLATION:
+            raise exceptions.ConflictException(
+                "Username already in use")
+        else:
+            raise exceptions.ConflictException(e.pgerror)
+
+async def update_user(cursor, user_id:int, new_username:str, new_password:str):
+    db_utils._check_username(new_username)
+
+    try:
+        async with transaction(cursor):
+            await cursor.execute(
+                '''
+                UPDATE Users
+                SET username=%s, password=%s
+                WHERE user_id=%s
+                RETURNING user_id;''',
+                [new_username, new_password, user_id])
+            result = await cursor.fetchone()
+            if result is None:
+                raise exceptions.NotFoundException(
+                    "User-id not found")
+
+            # delivered on commit, lets every process drop cached credentials
+            await cursor.execute(
+                "SELECT pg_notify(%s, %s);",
+                [db_utils.CREDENTIALS_CHANNEL, str(user_id)])
+        return result[0]
+
+    except ps.DataError as e:
+        if e.pgcode == errorcodes.STRING_DATA_RIGHT_TRUNCATION:
+            raise exceptions.BadRequestException(
+                '''Invalid username, it must contain alphanumeric
+                characters or \'-\' or \'_\'''')
+        else:
+            raise exceptions.BadRequestException(e.pgerror)
+
+    except ps.IntegrityError as e:
+        if e.pgcode == errorcodes.UNIQUE_VIOLATION:
+            raise exceptions.ConflictException(
+                "Username already in use")
+        else:
+            raise e
+
+async def query_users(cursor, **kwargs):
+    """
+    Same keyword arguments as db_utils.query_users.
+    """
+    sql, values, attrs = db_utils._users_query(**kwargs)
+    try:
+        await prepared.execute_async(cursor, sql, values)
+        return db_utils._to_dict(await cursor.fetchall(), attrs)
+
+    except ps.DataError as e:
+        if e.pgcode == errorcodes.STRING_DATA_RIGHT_TRUNCATION:
+            raise exceptions.BadRequestException(
+                '''Invalid username, it must contain only alphanumeric
+                characters or \'-\' or \'_\'''')
+        else:
+            raise exceptions.BadRequestException(e.pgerror)
+
+async def list_users(cursor, after_user_id=None, limit=None, user_ids=None,
+    usernames=None):
+    sql, values, _ = db_utils._users_query(
+        select_user_id=True, select_username=True,
+        after_user_id=after_user_id, limit=limit,
+        where_user_ids=user_ids, where_usernames=usernames)
+    try:
+        await prepared.execute_async(cursor, sql, values)
+        return serializer.Rows(await cursor.fetchall(), cursor.description)
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def iter_users(cursor, after_user_id=None, limit=None, chunk_size=1000,
+    user_ids=None, usernames=None):
+    """
+    Yield chunks of (user_id, username) serializer.Rows. aiopg has no
+    server-side cursors so every chunk is a keyset page of its own.
+    """
+    while limit is None or limit > 0:
+        page_size = chunk_size if limit is None else min(chunk_size, limit)
+        sql, values, _ = db_utils._users_query(
+            select_user_id=True, select_username=True,
+            after_user_id=after_user_id, limit=page_size,
+            where_user_ids=user_ids, where_usernames=usernames)
+        try:
+            await prepared.execute_async(cursor, sql, values)
+            rows = serializer.Rows(await cursor.fetchall(), cursor.description)
+        except ps.DataError as e:
+            raise exceptions.BadRequestException(e.pgerror)
+
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            break
+        after_user_id = rows[-1][0]
+        if limit is not None:
+            limit -= len(rows)
+
+#-------------------------------------------------------------------------------
+async def send_message(cursor, sender_id, receiver_ids, msg_text):
+    receiver_ids = list(dict.fromkeys(receiver_ids)) # drop duplicated receivers
+    assert len(receiver_ids) > 0
+
+    try:
+        async with transaction(cursor):
+            await cursor.execute(
+                db_utils._SEND_MESSAGE_SQL,
+                dict(db_utils._body(msg_text), sender_id=sender_id, broadcast=False))
+            insert_id = (await cursor.fetchone())[0]
+
+            await _insert_receivers(cursor, [insert_id]*len(receiver_ids), receiver_ids)
+            await _notify_new_messages(cursor, sender_id, [(insert_id, receiver_ids)])
+        return insert_id
+
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+    except ps.IntegrityError as e:
+        if e.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            raise exceptions.NotFoundException("At least one of the receiver-ids is not associated to a valid user!")
+        raise e
+
+async def send_messages(cursor, sender_id, messages):
+    messages = [(list(dict.fromkeys(receiver_ids)), msg_text)
+        for receiver_ids, msg_text in messages]
+    assert all(len(receiver_ids) > 0 for receiver_ids, _ in messages)
+    if len(messages) == 0:
+        return []
+
+    try:
+        async with transaction(cursor):
+            # reserve the ids up front so that they follow the input order
+            await cursor.execute(
+                '''
+                SELECT nextval(pg_get_serial_sequence('messages', 'message_id'))
+                FROM generate_series(1, %s);''', [len(messages)])
+            message_ids = sorted(row[0] for row in await cursor.fetchall())
+
+            body_rows, body_hashes = db_utils._bodies(
+                msg_text for _, msg_text in messages)
+            await cursor.execute(
+                '''
+                INSERT INTO MessageBodies (body_hash, compressed, body, search_vector)
+                SELECT b.body_hash, b.compressed, b.body, to_tsvector('simple', b.text)
+                FROM unnest(%s::bytea[], %s::bool[], %s::bytea[], %s::text[])
+                    as b (body_hash, compressed, body, text)
+                ON CONFLICT (body_hash) DO UPDATE
+                    SET compressed = MessageBodies.compressed;''',
+                [list(column) for column in zip(*body_rows)])
+            await cursor.execute(
+                '''
+                INSERT INTO Messages (message_id, sender_id, body_hash, timestamp)
+                SELECT unnest(%s::int[]), %s, unnest(%s::bytea[]), current_timestamp;''',
+                [message_ids, sender_id, body_hashes])
+
+            pairs = [(message_id, r)
+                for message_id, (receiver_ids, _) in zip(message_ids, messages)
+                for r in receiver_ids]
+            await _insert_receivers(
+                cursor, [m for m, _ in pairs], [r for _, r in pairs])
+            await _notify_new_messages(
+                cursor,
+                sender_id,
+                [(message_id, receiver_ids)
+                    for message_id, (receiver_ids, _) in zip(message_ids, messages)])
+        return message_ids
+
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+    except ps.IntegrityError as e:
+        if e.pgcode == errorcodes.FOREIGN_KEY_VIOLATION:
+            raise exceptions.NotFoundException("At least one of the receiver-ids is not associated to a valid user!")
+        raise e
+
+async def enqueue_message(cursor, sender_id, receiver_ids, msg_text):
+    receiver_ids = list(dict.fromkeys(receiver_ids)) # drop duplicated receivers
+    assert len(receiver_ids) > 0
+
+    try:
+        async with transaction(cursor):
+            # unknown receivers are still reported synchronously
+            await cursor.execute(
+                "SELECT count(*) FROM Users WHERE user_id = ANY(%s);",
+                [receiver_ids])
+            if (await cursor.fetchone())[0] != len(receiver_ids):
+                raise exceptions.NotFoundException("At least one of the receiver-ids is not associated to a valid user!")
+
+            await cursor.execute(
+                db_utils._ENQUEUE_MESSAGE_SQL,
+                dict(db_utils._body(msg_text),
+                    sender_id=sender_id,
+                    receiver_ids=receiver_ids))
+            job_id, message_id = await cursor.fetchone()
+
+            await cursor.execute(
+                "SELECT pg_notify(%s, %s);",
+                [db_utils.SEND_JOBS_CHANNEL, str(job_id)])
+        return job_id, message_id
+
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_job(cursor, job_id):
+    try:
+        await cursor.execute(db_utils._GET_JOB_SQL, [job_id])
+        result = await cursor.fetchone()
+        if result is None:
+            raise exceptions.NotFoundException("Job-id not found")
+        return db_utils._to_dict([result], db_utils._JOB_ATTRIBUTES)[0]
+
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def broadcast_message(cursor, sender_id, message_text):
+    try:
+        async with transaction(cursor):
+            await cursor.execute(
+                db_utils._SEND_MESSAGE_SQL,
+                dict(db_utils._body(message_text), sender_id=sender_id, broadcast=True))
+            message_id = (await cursor.fetchone())[0]
+            await _notify_new_messages(cursor, sender_id, [(message_id, None)])
+        return message_id
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def _insert_receivers(cursor, message_ids, receiver_ids):
+    # set based insert of the zipped (message_id, receiver_id) arrays
+    await cursor.execute(
+        '''
+        INSERT INTO Receivers (message_id, receiver_id, timestamp)
+        SELECT r.message_id, r.receiver_id, m.timestamp
+        FROM unnest(%s::int[], %s::int[]) as r (message_id, receiver_id), Messages as m
+        WHERE m.message_id = r.message_id;''',
+        [message_ids, receiver_ids])
+
+async def _notify_new_messages(cursor, sender_id, messages):
+    await cursor.execute(
+        db_utils._NOTIFY_NEW_MESSAGES_SQL,
+        [db_utils.NEW_MESSAGE_CHANNEL,
+         db_utils._new_message_payloads(sender_id, messages)])
+
+#-------------------------------------------------------------------------------
+async def get_message(cursor, user_id, message_id):
+    try:
+        async with transaction(cursor):
+            await prepared.execute_async(
+                cursor,
+                db_utils._GET_MESSAGE_SQL,
+                {"message_id": message_id, "user_id": user_id})
+            return db_utils._message_result(
+                await cursor.fetchone(), user_id, message_id)
+
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_message_version(cursor, user_id, message_id):
+    try:
+        async with transaction(cursor):
+            await prepared.execute_async(
+                cursor,
+                db_utils._MESSAGE_VERSION_SQL,
+                {"message_id": message_id, "user_id": user_id})
+            return db_utils._message_version_result(
+                await cursor.fetchone(), user_id)
+
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_version(cursor, listing, user_id=None):
+    try:
+        await prepared.execute_async(cursor, db_utils._VERSION_SQL[listing], {"user_id": user_id})
+        return list(await cursor.fetchone())
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_wal_lsn(cursor):
+    await cursor.execute(db_utils._WAL_LSN_SQL)
+    return (await cursor.fetchone())[0]
+
+async def has_replayed(cursor, lsn):
+    try:
+        await cursor.execute(db_utils._REPLAYED_SQL, [lsn])
+        return (await cursor.fetchone())[0]
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def delete_message(cursor, user_id, message_id):
+    try:
+        async with transaction(cursor):
+            await cursor.execute(
+                db_utils._DELETE_MESSAGE_SQL,
+                {"message_id": message_id, "user_id": user_id})
+            db_utils._check_deleted(await cursor.fetchone())
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_unread_count(cursor, user_id):
+    try:
+        await prepared.execute_async(cursor, db_utils._UNREAD_COUNT_SQL, {"user_id": user_id})
+        return (await cursor.fetchone())[0]
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_received_messages(cursor, user_id, limit=None, after=None, unread=False,
+    sender_username=False):
+    sql, values = db_utils._received_messages_query(
+        user_id, limit, after, unread, sender_username)
+    return await _fetch_messages(cursor, sql, values)
+
+async def mark_read(cursor, user_id, message_ids=None, before=None):
+    sql, values = db_utils._mark_read_query(user_id, message_ids, before)
+    try:
+        async with transaction(cursor):
+            await prepared.execute_async(cursor, sql, values)
+            return (await cursor.fetchone())[0]
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def get_sent_messages(cursor, user_id, limit=None, after=None):
+    sql, values = db_utils._sent_messages_query(user_id, limit, after)
+    return await _fetch_messages(cursor, sql, values)
+
+async def search_messages(cursor, user_id, query, limit=None, after=None):
+    sql, values = db_utils._search_messages_query(user_id, query, limit, after)
+    try:
+        await prepared.execute_async(cursor, sql, values)
+        return db_utils._search_results(await cursor.fetchall(), cursor.description)
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def iter_received_messages(cursor, user_id, limit=None, after=None,
+    unread=False, sender_username=False, chunk_size=1000):
+    query = functools.partial(
+        db_utils._received_messages_query,
+        unread=unread, sender_username=sender_username)
+    async for rows in _iter_messages(
+        cursor, query,
+        user_id, limit, after, chunk_size):
+        yield rows
+
+async def iter_sent_messages(cursor, user_id, limit=None, after=None, chunk_size=1000):
+    async for rows in _iter_messages(
+        cursor, db_utils._sent_messages_query, user_id, limit, after, chunk_size):
+        yield rows
+
+async def _fetch_messages(cursor, sql, values):
+    try:
+        await prepared.execute_async(cursor, sql, values)
+        return serializer.Rows(await cursor.fetchall(), cursor.description)
+    except ps.DataError as e:
+        raise exceptions.BadRequestException(e.pgerror)
+
+async def _iter_messages(cursor, query, user_id, limit, after, chunk_size):
+    # keyset pages of chunk_size (message_id, sender_id, timestamp) rows
+    while limit is None or limit > 0:
+        page_size = chunk_size if limit is None else min(chunk_size, limit)
+        sql, values = query(user_id, page_size, after)
+        try:
+            await prepared.execute_async(cursor, sql, values)
+            rows = serializer.Rows(await cursor.fetchall(), cursor.description)
+        except ps.DataError as e:
+            raise exceptions.BadRequestException(e.pgerror)
+
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            break
+        after = [rows.last("timestamp"), rows.last("message_id")]
+        if limit is not None:
+            limit -= len(rows)
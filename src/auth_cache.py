@@ -0,0 +1,111 @@
+import collections
+import hashlib
+import threading
+import time
+
+
+class CredentialCache:
+    """
+    Size-bounded LRU cache mapping verified Basic-auth credentials to their
+    user-id, entries expire after `ttl` seconds.
+
+    Credentials are stored as a SHA-256 digest so plain text passwords never
+    stay in memory. Every invalidation bumps a generation counter, a lookup
+    started before an invalidation is not allowed to put its (possibly stale)
+    result in the cache.
+    """
+
+    def __init__(self, max_size:int=10000, ttl:float=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = collections.OrderedDict() # key -> (user_id, expiry)
+        self._keys_by_user = collections.defaultdict(set)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, username:str, password:str):
+        """
+        Return the cached user-id of the credentials or None.
+        """
+        key = _key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def peek(self, username:str, password:str):
+        """
+        Like get, without counting the lookup or refreshing the entry.
+        """
+        key = _key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                return entry[0]
+            return None
+
+    def generation(self) -> int:
+        return self._generation
+
+    def put(self, username:str, password:str, user_id:int, generation:int):
+        """
+        Cache the user-id of verified credentials, `generation` must be read
+        before querying the database.
+        """
+        if self.max_size <= 0:
+            return
+        key = _key(username, password)
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (user_id, time.monotonic() + self.ttl)
+            self._keys_by_user[user_id].add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_user(self, user_id:int):
+        with self._lock:
+            self._generation += 1
+            for key in self._keys_by_user.pop(user_id, ()):
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries),
+                    "max_size": self.max_size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    #---------------------------------------------------------------------------
+    def _remove(self, key):
+        user_id, _ = self._entries.pop(key)
+        keys = self._keys_by_user[user_id]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_user[user_id]
+
+
+def _key(username, password):
+    return hashlib.sha256(
+        username.encode('utf-8') + b'\0' + password.encode('utf-8')).digest()
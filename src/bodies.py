@@ -0,0 +1,33 @@
+import hashlib
+import zlib
+
+# Content-addressed message bodies. The texts are stored once in MessageBodies
+# under the SHA-256 of their UTF-8 encoding, which the messages reference, so
+# that the texts sent over and over (e.g. by automated senders) take no more
+# space and their inserts are no-ops. The bodies longer than compress_min_size
+# bytes are stored compressed with zlib when that makes them smaller.
+
+# bodies (in bytes) shorter than this are stored as is, None to never compress
+compress_min_size = 256
+
+COMPRESS_LEVEL = 6
+
+def encode(text:str):
+    """
+    Return the (body_hash, compressed, body) row storing the text.
+    """
+    data = text.encode("utf-8")
+    body_hash = hashlib.sha256(data).digest()
+    if compress_min_size is not None and len(data) >= compress_min_size:
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(compressed) < len(data):
+            return body_hash, True, compressed
+    return body_hash, False, data
+
+def decode(compressed:bool, body) -> str:
+    """
+    Return the text of a stored body (bytes or a memoryview of them).
+    """
+    if compressed:
+        return zlib.decompress(body).decode("utf-8")
+    return bytes(body).decode("utf-8")
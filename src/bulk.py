@@ -0,0 +1,319 @@
+import argparse
+import collections
+import json
+import os
+
+import psycopg2 as ps
+
+import db_utils
+import migrations
+
+# Bulk export and import of the users and of the messages through COPY, as
+# CSV or NDJSON files (one per table) in a directory.
+#
+# The export runs in chunks of key ranges, each one appended to the file of
+# its table and recorded (with its byte offsets) in manifest.json, which is
+# the checkpoint of the export: a resumed export drops the data written after
+# the last recorded chunk and goes on from there. An export reads all the
+# tables in a single REPEATABLE READ transaction, so that every exported row
+# has what it refers to (e.g. the body of a message sent during the export);
+# a resumed export reads the rest in a new one, the source must not change
+# in between for its files to stay consistent. The import loads the chunks
+# listed in the manifest one transaction at a time, through a staging table
+# so that loading a chunk twice is harmless, and records its progress in its
+# own checkpoint file. A user already present is skipped only if it is the
+# same user (same id and username), the import fails otherwise. The counters
+# (Mailboxes, Outboxes, Versions) are maintained by the triggers as usual. An
+# export can only be imported into a database at the same schema version.
+
+MANIFEST = "manifest.json"
+IMPORT_CHECKPOINT = "import_checkpoint.json"
+
+Table = collections.namedtuple("Table", ["name", "columns", "bound", "select"])
+
+# in dependency order, each select takes the (exclusive, inclusive) range
+# %(low)s to %(high)s of the keys of the bound table, whose maximum key (at the
+# start of the export) limits the exported rows
+TABLES = [
+    Table("Users", ["user_id", "username", "password", "created_at"], "Users",
+        '''
+        SELECT user_id, username, password, created_at
+        FROM Users
+        WHERE user_id > %(low)s AND user_id <= %(high)s
+        ORDER BY user_id'''),
+    # the bodies of the messages of the range, a body shared by the messages
+    # of several ranges is exported with each of them
+    Table("MessageBodies", ["body_hash", "compressed", "body", "search_vector"],
+        "Messages",
+        '''
+        SELECT body_hash, compressed, body, search_vector
+        FROM MessageBodies
+        WHERE body_hash IN (
+            SELECT body_hash FROM Messages
+            WHERE message_id > %(low)s AND message_id <= %(high)s)'''),
+    Table("Messages", ["message_id", "sender_id", "body_hash", "timestamp",
+        "broadcast"], "Messages",
+        '''
+        SELECT message_id, sender_id, body_hash, timestamp, broadcast
+        FROM Messages
+        WHERE message_id > %(low)s AND message_id <= %(high)s
+        ORDER BY message_id'''),
+    Table("Receivers", ["message_id", "receiver_id", "message_read", "timestamp"],
+        "Messages",
+        '''
+        SELECT message_id, receiver_id, message_read, timestamp
+        FROM Receivers
+        WHERE message_id > %(low)s AND message_id <= %(high)s
+        ORDER BY message_id, receiver_id'''),
+]
+
+# keys of the bound tables, which have a serial sequence
+_KEYS = {"Users": "user_id", "Messages": "message_id"}
+
+# CSV options making COPY read and write one JSON document per line, as no
+# JSON text contains these control characters unescaped
+_NDJSON_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+
+def export(database_url, directory, file_format="csv", chunk_size=100000):
+    """
+    Export the tables into the directory, resuming a previous export if the
+    directory has its manifest.
+    """
+    manifest = _read_json(os.path.join(directory, MANIFEST))
+    if manifest is not None and manifest["complete"]:
+        print("Export already complete")
+        return manifest
+
+    conn = ps.connect(database_url)
+    try:
+        # one snapshot for the bounds and all the chunks
+        conn.set_session(
+            isolation_level=ps.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+            readonly=True)
+        cur = conn.cursor()
+        cur.execute("SET TIME ZONE 'UTC';")
+        if manifest is None:
+            os.makedirs(directory, exist_ok=True)
+            manifest = {"format": file_format,
+                        "schema_version": migrations.current_version(cur),
+                        "bounds": {}, "tables": {}, "complete": False}
+            for name, key in _KEYS.items():
+                cur.execute("SELECT COALESCE(MAX(%s), 0) FROM %s;" % (key, name))
+                manifest["bounds"][name] = cur.fetchone()[0]
+            # months of the exported messages, partitions of the import
+            cur.execute(
+                '''
+                SELECT (min(timestamp) AT TIME ZONE 'UTC')::date::text,
+                    (max(timestamp) AT TIME ZONE 'UTC')::date::text
+                FROM Messages
+                WHERE message_id <= %s;''', [manifest["bounds"]["Messages"]])
+            manifest["months"] = list(cur.fetchone())
+            for table in TABLES:
+                manifest["tables"][table.name] = {
+                    "file": "%s.%s" % (table.name.lower(), file_format),
+                    "columns": table.columns,
+                    "done_until": 0,
+                    "chunks": []}
+            _write_json(os.path.join(directory, MANIFEST), manifest)
+
+        for table in TABLES:
+            _export_table(cur, directory, manifest, table, chunk_size)
+        conn.commit()
+        cur.close()
+
+        manifest["complete"] = True
+        _write_json(os.path.join(directory, MANIFEST), manifest)
+        return manifest
+    finally:
+        conn.close()
+
+def _export_table(cursor, directory, manifest, table, chunk_size):
+    state = manifest["tables"][table.name]
+    bound = manifest["bounds"][table.bound]
+    path = os.path.join(directory, state["file"])
+    options = _NDJSON_OPTIONS if manifest["format"] == "ndjson" else "FORMAT csv"
+
+    with open(path, "ab") as f:
+        # drop what was written after the last checkpoint
+        end = state["chunks"][-1][1] if state["chunks"] else 0
+        f.truncate(end)
+        f.seek(end)
+
+        while state["done_until"] < bound:
+            low = state["done_until"]
+            high = min(low + chunk_size, bound)
+            select = cursor.mogrify(
+                table.select, {"low": low, "high": high}).decode()
+            if manifest["format"] == "ndjson":
+                select = "SELECT row_to_json(t) FROM (%s) as t" % select
+            sql = "COPY (%s) TO STDOUT WITH (%s)" % (select, options)
+            cursor.copy_expert(sql, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+            state["chunks"].append([end, f.tell()])
+            state["done_until"] = high
+            end = f.tell()
+            _write_json(os.path.join(directory, MANIFEST), manifest)
+        print("Exported %s up to %s %d" % (table.name, _KEYS[table.bound], bound))
+
+def import_(database_url, directory, checkpoint=None):
+    """
+    Import an export directory, resuming from the checkpoint file if any.
+    """
+    manifest = _read_json(os.path.join(directory, MANIFEST))
+    if manifest is None or not manifest["complete"]:
+        raise ValueError("%s is not a complete export" % directory)
+    checkpoint = checkpoint or os.path.join(directory, IMPORT_CHECKPOINT)
+    progress = _read_json(checkpoint) or {}
+
+    conn = ps.connect(database_url)
+    try:
+        cur = conn.cursor()
+        version = migrations.current_version(cur)
+        if version != manifest["schema_version"]:
+            raise ValueError("%s was exported at schema version %d, not %d" % (
+                directory, manifest["schema_version"], version))
+        cur.execute("SET TIME ZONE 'UTC';")
+        if manifest["months"][0] is not None:
+            cur.execute("SELECT create_message_partitions(%s, %s);",
+                manifest["months"])
+            conn.commit()
+        for table in TABLES:
+            state = manifest["tables"][table.name]
+            staging = _create_staging(cur, table, manifest["format"])
+            conn.commit()
+
+            path = os.path.join(directory, state["file"])
+            skipped = 0
+            with open(path, "rb") as f:
+                for index in range(progress.get(table.name, 0), len(state["chunks"])):
+                    start, end = state["chunks"][index]
+                    f.seek(start)
+                    skipped += _import_chunk(cur, table, state["columns"], staging,
+                        manifest["format"], _Range(f, end - start))
+                    conn.commit()
+                    progress[table.name] = index + 1
+                    _write_json(checkpoint, progress)
+            print("Imported %s (%d rows already present skipped)" % (
+                table.name, skipped))
+
+        # the keys were given explicitly
+        for name, key in _KEYS.items():
+            cur.execute(
+                "SELECT setval(pg_get_serial_sequence(%%s, %%s), MAX(%s)) FROM %s;"
+                % (key, name), [name, key])
+        conn.commit()
+        cur.close()
+    finally:
+        conn.close()
+
+def _create_staging(cursor, table, file_format):
+    # temporary table emptied at every commit
+    staging = "bulk_" + table.name.lower()
+    if file_format == "ndjson":
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS %s (document json) ON COMMIT DELETE ROWS;"
+            % staging)
+    else:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS %s (LIKE %s) ON COMMIT DELETE ROWS;"
+            % (staging, table.name))
+    return staging
+
+def _import_chunk(cursor, table, columns, staging, file_format, f):
+    # return the number of rows skipped
+    columns = ", ".join(columns)
+    if file_format == "ndjson":
+        cursor.copy_expert(
+            "COPY %s (document) FROM STDIN WITH (%s)" % (staging, _NDJSON_OPTIONS), f)
+        source = "SELECT r.* FROM %s, json_populate_record(NULL::%s, document) as r" % (
+            staging, table.name)
+    else:
+        cursor.copy_expert(
+            "COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (staging, columns), f)
+        source = "SELECT * FROM %s" % staging
+
+    # rows already there (e.g. a chunk imported again) are skipped, but not
+    # other users with the same ids, who would get the imported messages, nor
+    # with the same usernames (a unique violation)
+    conflict = "ON CONFLICT DO NOTHING"
+    if table.name == "Users":
+        cursor.execute(
+            '''
+            SELECT s.user_id, u.username
+            FROM (%s) as s
+            JOIN Users as u ON u.user_id = s.user_id
+            WHERE u.username <> s.username
+            LIMIT 1;''' % source)
+        row = cursor.fetchone()
+        if row is not None:
+            raise ValueError("User-id %d is already used by %s" % row)
+        conflict = "ON CONFLICT (user_id) DO NOTHING"
+
+    cursor.execute("SELECT count(*) FROM %s;" % staging)
+    staged = cursor.fetchone()[0]
+    cursor.execute(
+        "INSERT INTO %s (%s) SELECT %s FROM (%s) as s %s;"
+        % (table.name, columns, columns, source, conflict))
+    return staged - cursor.rowcount
+
+class _Range:
+    """
+    File-like object reading at most size bytes from the current position of f.
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.readline(size)
+        self.remaining -= len(data)
+        return data
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def _write_json(path, data):
+    # atomic replacement, the checkpoint is either the old or the new one
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+#===============================================================================
+# check if the module is being executed
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Bulk export and import of the users and of the messages")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("directory")
+    parser.add_argument("database_url", nargs="?", default=db_utils.DEFAULT_DB)
+    parser.add_argument("--format", choices=["csv", "ndjson"], default="csv",
+        help="file format of a new export")
+    parser.add_argument("--chunk-size", type=int, default=100000,
+        help="range of keys exported per chunk")
+    parser.add_argument("--checkpoint",
+        help="progress file of the import (default: in the export directory)")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(args.database_url, args.directory, args.format, args.chunk_size)
+    else:
+        import_(args.database_url, args.directory, args.checkpoint)
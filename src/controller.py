@@ -2,34 +2,267 @@ import psycopg2 as ps
 import connexion
 import flask
 
+import functools
+import itertools
+import queue
+import time
+
+import admission
+import auth_cache
+import bodies
+import db_listener
+import db_pool
 import db_utils
 import exceptions
-
-
-connection = None
-database_url = ""
-
-def connect(db_url):
-    global connection
-    global database_url
-    database_url = db_url
-    connection = ps.connect(database_url)
+import metrics
+import serializer
+import subscriptions
+
+
+pool = None
+replica_pools = []
+listener = None
+credentials_cache = auth_cache.CredentialCache()
+rate_limiter = admission.RateLimiter()
+concurrency_limiter = admission.ConcurrencyLimiter()
+stream_limiter = admission.ConcurrencyLimiter()
+new_messages = subscriptions.Subscriptions()
+
+# seconds between two keep-alive comments on an idle event stream
+STREAM_KEEPALIVE = 15.0
+
+# token of the WAL position of the primary after the writes of a client,
+# returned with the responses using the primary and sent back by the client
+# so that the replicas serve its reads only once they have replayed them
+SESSION_LSN_HEADER = "X-Session-LSN"
+
+_next_replica = itertools.count()
+
+def connect(
+    db_url,
+    min_size=1,
+    max_size=10,
+    timeout=5.0,
+    auth_cache_size=10000,
+    auth_cache_ttl=60.0,
+    slow_query_ms=1000,
+    body_compress_min_size=256,
+    replica_urls=(),
+    rate_limits=None,
+    max_concurrent=None,
+    admission_timeout=0.1,
+    threads=None,
+    max_streams=None):
+
+    """
+    Open the connection pools and start the listener of the process, `threads`
+    is the number of threads serving the requests of the process and
+    `max_streams` the event streams open at the same time (no limit if None).
+    """
+    global pool
+    global replica_pools
+    global listener
+    global credentials_cache
+    global rate_limiter
+    global concurrency_limiter
+    global stream_limiter
+    pool = db_pool.ConnectionPool(
+        db_url,
+        min_size=min_size,
+        max_size=max_size,
+        timeout=timeout,
+        cursor_factory=metrics.InstrumentedCursor)
+
+    # opened lazily, a replica that is down at startup is skipped until it is up
+    replica_pools = [
+        db_pool.ConnectionPool(
+            url,
+            min_size=0,
+            max_size=max_size,
+            timeout=timeout,
+            cursor_factory=metrics.InstrumentedCursor)
+        for url in replica_urls]
+    metrics.POOL_CONNECTIONS.collect = _pool_connections
+    metrics.slow_query_seconds = slow_query_ms / 1000.0 if slow_query_ms else None
+    bodies.compress_min_size = body_compress_min_size or None
+
+    # no more operations at once than connections of the pool (or threads) by default
+    rate_limiter = admission.RateLimiter(rate_limits)
+    if max_concurrent is None:
+        max_concurrent = max_size if threads is None else min(threads, max_size)
+    concurrency_limiter = admission.ConcurrencyLimiter(
+        max_concurrent, admission_timeout)
+    stream_limiter = admission.ConcurrencyLimiter(max_streams, timeout=0)
+
+    # cached credentials are dropped when any process changes them
+    credentials_cache = auth_cache.CredentialCache(
+        max_size=auth_cache_size,
+        ttl=auth_cache_ttl)
+    metrics.collect_auth_cache(credentials_cache)
+    listener = db_listener.Listener(db_url)
+    listener.subscribe(
+        db_utils.CREDENTIALS_CHANNEL,
+        lambda payload: credentials_cache.invalidate_user(int(payload)))
+    listener.on_reconnect(credentials_cache.clear)
+
+    # one listener connection per process fans new messages out to the streams
+    listener.subscribe(db_utils.NEW_MESSAGE_CHANNEL, new_messages.publish)
+    listener.on_reconnect(new_messages.resync)
+    listener.start()
+
+def resolve(operation_id):
+    """
+    Map the controller.<name> operation ids of swagger.yml to the functions
+    of this module, behind the admission control and instrumented by metrics.
+    """
+    name = operation_id.rpartition('.')[2]
+    return metrics.instrument(name)(_admitted(name, globals()[name]))
+
+def _admitted(operation, f):
+    # see admission.py, the limits are read on every call as connect sets them
+    if operation in admission.EXEMPT:
+        return f
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        auth = connexion.request.authorization
+        if auth is not None:
+            user_id = credentials_cache.peek(auth.username, auth.password)
+            if user_id is not None:
+                rate_limiter.admit(user_id, operation)
+
+        # a streamed listing keeps its slot (and connection) until it is sent
+        limiter = concurrency_limiter
+        limiter.acquire()
+        try:
+            response = f(*args, **kwargs)
+        except BaseException:
+            limiter.release()
+            raise
+        if isinstance(response, flask.Response) and response.is_streamed:
+            response.call_on_close(limiter.release)
+        else:
+            limiter.release()
+        return response
+    return wrapper
 
 def get_connection():
-    global connection
-    if connection.closed:
-        connect(database_url)
-        return connection
-    else:
-        return connection
- 
+    """
+    Return the connection of the current request, checking one out of the
+    pool the first time it is needed.
+    """
+    if "db_connection" not in flask.g:
+        start = time.perf_counter()
+        try:
+            flask.g.db_connection = pool.getconn()
+        finally:
+            metrics.POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+    return flask.g.db_connection
+
+def get_read_connection():
+    """
+    Return the connection of the current request for a read-only operation:
+    one of a replica (in turn) that has replayed the writes of the session
+    token of the request, if any, otherwise the one of the primary.
+    """
+    if "db_read_connection" not in flask.g:
+        connection = None
+        if replica_pools:
+            connection = _replica_connection(
+                flask.request.headers.get(SESSION_LSN_HEADER))
+        if connection is None:
+            connection = get_connection()
+        flask.g.db_read_connection = connection
+    return flask.g.db_read_connection
+
+def _replica_connection(lsn):
+    if lsn is not None and not db_utils.is_lsn(lsn):
+        metrics.READ_ROUTING.inc(("primary",))
+        return None
+
+    start = next(_next_replica)
+    for i in range(len(replica_pools)):
+        replica_pool = replica_pools[(start + i) % len(replica_pools)]
+        try:
+            connection = replica_pool.getconn()
+        except exceptions.ServiceUnavailableException:
+            continue
+        try:
+            with connection.cursor() as cur:
+                replayed = lsn is None or db_utils.has_replayed(cur, lsn)
+        except ps.Error:
+            replica_pool.putconn(connection, discard=True)
+            continue
+        if replayed:
+            flask.g.db_replica = (replica_pool, connection)
+            metrics.READ_ROUTING.inc(("replica",))
+            return connection
+        replica_pool.putconn(connection)
+
+    # lagging or unavailable replicas
+    metrics.READ_ROUTING.inc(("primary",))
+    return None
+
+def release_connection(exception=None):
+    """
+    Give the connections of the current request (if any) back to their pools,
+    registered as an app-context teardown callback.
+    """
+    flask.g.pop("db_read_connection", None)
+    replica = flask.g.pop("db_replica", None)
+    if replica is not None:
+        replica[0].putconn(replica[1])
+    connection = flask.g.pop("db_connection", None)
+    if connection is not None:
+        pool.putconn(connection)
+
+def add_session_lsn(response):
+    """
+    Add the session token to the responses of the requests that used the
+    primary when there are replicas, registered as an after-request callback.
+    """
+    connection = flask.g.get("db_connection")
+    if replica_pools and connection is not None and not connection.closed:
+        cur = connection.cursor()
+        try:
+            response.headers[SESSION_LSN_HEADER] = db_utils.get_wal_lsn(cur)
+        except ps.Error:
+            pass
+        finally:
+            cur.close()
+    return response
+
 def close_connection():
-    connection.close()
+    if listener is not None:
+        listener.stop()
+    if pool is not None:
+        pool.closeall()
+    for replica_pool in replica_pools:
+        replica_pool.closeall()
+
+def handle_retry_later(e):
+    """
+    Answer the 429 and 503 errors raised outside of the operations (admission
+    control, connection pool) with their Retry-After header.
+    """
+    return (flask.json.dumps(e.description), e.code,
+        dict(e.retry_after_header, **{'Content-Type': 'application/json'}))
+
+def _pool_connections():
+    stats = pool.stats()
+    return {("open",): stats["size"],
+            ("idle",): stats["idle"],
+            ("max",): stats["max_size"]}
+
+#metrics -----------------------------------------------------------------------
+def get_metrics():
+    return flask.Response(
+        metrics.render(), mimetype="text/plain; version=0.0.4")
 
 #users/ ------------------------------------------------------------------------
 def add_user(user_info):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         _check_credentials(cur)
 
         new_user_id = db_utils.add_user(
@@ -45,16 +278,37 @@ def add_user(user_info):
     finally:
         cur.close()
 
-def get_all_users():
+def get_all_users(limit=None, after=None, stream=False, ids=None, usernames=None):
+    cur = None
     try:
-        cur = get_connection().cursor()
-        _check_credentials(cur)
-
-        users = db_utils.query_users(
+        _check_credentials()
+        cur = get_read_connection().cursor()
+        after_user_id = (None if after is None else
+            db_utils.decode_cursor(after, [int])[0])
+
+        etag = db_utils.make_etag(
+            "users", db_utils.get_version(cur, "users"), limit, after, stream,
+            ids, usernames)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+
+        if stream:
+            chunks = db_utils.stream_users(
+                connection=get_read_connection(),
+                after_user_id=after_user_id,
+                limit=limit,
+                user_ids=ids,
+                usernames=usernames)
+            return _stream_response(chunks, etag)
+
+        users = db_utils.list_users(
             cursor=cur,
-            select_username=True,
-            select_user_id=True)
-        return users, 200
+            after_user_id=after_user_id,
+            limit=_page_limit(limit),
+            user_ids=ids,
+            usernames=usernames)
+        return _page(users, limit, ["user_id"], etag)
 
 
     except exceptions.UnauthorizedException as e:
@@ -62,18 +316,28 @@ def get_all_users():
     except exceptions.ResponseException as e:
         return e.description, e.code
     finally:
-        cur.close()
+        if cur is not None:
+            cur.close()
 
 # users/{user_id} --------------------------------------------------------------
-def send_message(message):
+def send_message(message, deferred=False):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         sender_id = _check_credentials(cur)
 
         # TODO throw error if attributes not in dict
         message_text = message["message_text"]
         receiver_ids = message["receiver_ids"]
 
+        # the delivery to the receivers is left to the worker process
+        if deferred:
+            job_id, msg_id = db_utils.enqueue_message(
+                cursor=cur,
+                receiver_ids=receiver_ids,
+                sender_id=sender_id,
+                msg_text=message_text)
+            return {"job_id": job_id, "message_id": msg_id}, 202
+
         msg_id = db_utils.send_message(
             cursor=cur,
             receiver_ids=receiver_ids,
@@ -89,13 +353,32 @@ def send_message(message):
     finally:
         cur.close()
 
+def send_messages(messages):
+    cur = get_connection().cursor()
+    try:
+        sender_id = _check_credentials(cur)
+
+        message_ids = db_utils.send_messages(
+            cursor=cur,
+            sender_id=sender_id,
+            messages=[(m["receiver_ids"], m["message_text"]) for m in messages])
+        return message_ids, 201
+
+
+    except exceptions.UnauthorizedException as e:
+        return e.description, e.code, e.authentication_header
+    except exceptions.ResponseException as e:
+        return e.description, e.code
+    finally:
+        cur.close()
+
 def update_user(user_id, user_info):
+    cur = get_connection().cursor()
     try:
         # TODO raise exception if attributes not in dir
         username = user_info["username"]
         password = user_info["password"]
 
-        cur = get_connection().cursor()
         authorized_user_id = _check_credentials(cur)
         if authorized_user_id != user_id:
             raise exceptions.UnauthorizedException(
@@ -106,6 +389,7 @@ def update_user(user_id, user_info):
             user_id=user_id,
             new_username=username,
             new_password=password)
+        credentials_cache.invalidate_user(user_id)
 
         if result is None:
             raise exceptions.NotFoundException("Given user-id not found")
@@ -121,9 +405,16 @@ def update_user(user_id, user_info):
         cur.close()
 
 def get_user(user_id):
+    cur = None
     try:
-        cur = get_connection().cursor()
-        _check_credentials(cur)
+        _check_credentials()
+        cur = get_read_connection().cursor()
+
+        etag = db_utils.make_etag(
+            "user", db_utils.get_version(cur, "users"), user_id)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
 
         results = db_utils.query_users(
             cursor=cur,
@@ -133,19 +424,21 @@ def get_user(user_id):
         if len(results) == 0:
             raise exceptions.NotFoundException(
                 "Given user-id not found")
-        return results[0], 200
+        return results[0], 200, _etag_header(etag)
 
     except exceptions.UnauthorizedException as e:
         return e.description, e.code, e.authentication_header
     except exceptions.ResponseException as e:
         return e.description, e.code
     finally:
-        cur.close()
+        if cur is not None:
+            cur.close()
 
 def get_user_v2(username):
+    cur = None
     try:
-        cur = get_connection().cursor()
-        _check_credentials(cur)
+        _check_credentials()
+        cur = get_read_connection().cursor()
 
         results = db_utils.query_users(
             cursor=cur,
@@ -162,17 +455,18 @@ def get_user_v2(username):
     except exceptions.ResponseException as e:
         return e.description, e.code
     finally:
-        cur.close()
+        if cur is not None:
+            cur.close()
 
 # users/all --------------------------------------------------------------------
 def broadcast_message(message):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         user_id = _check_credentials(cur)
         message_text = message.decode('utf-8')
 
         message_id = db_utils.broadcast_message(cur, user_id, message_text)
-        return  message_id, 200
+        return  message_id, 201
 
     except exceptions.UnauthorizedException as e:
         return e.description, e.code, e.authentication_header
@@ -182,16 +476,61 @@ def broadcast_message(message):
         cur.close()
 
 # user/{user_id}/received ------------------------------------------------------
-def get_received_messages(user_id):
+def get_received_messages(user_id, limit=None, after=None, stream=False, unread=False,
+    sender_username=False):
+    cur = None
+    try:
+        authorized_user_id = _check_credentials()
+        if authorized_user_id != user_id:
+            raise exceptions.UnauthorizedException(
+                "Not enough rights to access the user's received messages!")
+        cur = get_read_connection().cursor()
+
+        after_key = None if after is None else db_utils.decode_cursor(after, [str, int])
+
+        # the usernames change with the version of the users
+        versions = db_utils.get_version(cur, "received", user_id)
+        if sender_username:
+            versions += db_utils.get_version(cur, "users")
+        etag = db_utils.make_etag(
+            "received", user_id, versions, limit, after, stream, unread,
+            sender_username)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+
+        if stream:
+            chunks = db_utils.stream_received_messages(
+                get_read_connection(), user_id, limit, after_key, unread,
+                sender_username)
+            return _stream_response(chunks, etag)
+
+        messages = db_utils.get_received_messages(
+            cur, user_id, _page_limit(limit), after_key, unread, sender_username)
+        return _page(messages, limit, ["timestamp", "message_id"], etag)
+
+    except exceptions.UnauthorizedException as e:
+        return e.description, e.code, e.authentication_header
+    except exceptions.ResponseException as e:
+        return e.description, e.code
+    finally:
+        if cur is not None:
+            cur.close()
+
+def mark_read(user_id, selection):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         authorized_user_id = _check_credentials(cur)
         if authorized_user_id != user_id:
             raise exceptions.UnauthorizedException(
                 "Not enough rights to access the user's received messages!")
 
-        messages = db_utils.get_received_messages(cur, user_id)
-        return  messages, 200
+        marked = db_utils.mark_read(
+            cursor=cur,
+            user_id=user_id,
+            message_ids=selection.get("message_ids"),
+            before=selection.get("before"))
+        return {"marked": marked}, 200
 
     except exceptions.UnauthorizedException as e:
         return e.description, e.code, e.authentication_header
@@ -201,16 +540,91 @@ def get_received_messages(user_id):
         cur.close()
 
 # user/{user_id}/sent ----------------------------------------------------------
-def get_sent_messages(user_id):
+def get_sent_messages(user_id, limit=None, after=None, stream=False):
+    cur = None
+    try:
+        authorized_user_id = _check_credentials()
+        if authorized_user_id != user_id:
+            raise exceptions.UnauthorizedException(
+                "Not enough rights to access the user's received messages!")
+        cur = get_read_connection().cursor()
+
+        after_key = None if after is None else db_utils.decode_cursor(after, [str, int])
+
+        etag = db_utils.make_etag(
+            "sent", user_id, db_utils.get_version(cur, "sent", user_id),
+            limit, after, stream)
+        not_modified = _not_modified(etag)
+        if not_modified is not None:
+            return not_modified
+
+        if stream:
+            chunks = db_utils.stream_sent_messages(
+                get_read_connection(), user_id, limit, after_key)
+            return _stream_response(chunks, etag)
+
+        messages = db_utils.get_sent_messages(
+            cur, user_id, _page_limit(limit), after_key)
+        return _page(messages, limit, ["timestamp", "message_id"], etag)
+
+    except exceptions.UnauthorizedException as e:
+        return e.description, e.code, e.authentication_header
+    except exceptions.ResponseException as e:
+        return e.description, e.code
+    finally:
+        if cur is not None:
+            cur.close()
+
+# user/{user_id}/search --------------------------------------------------------
+def search_messages(user_id, q, limit=None, after=None):
+    cur = None
+    try:
+        authorized_user_id = _check_credentials()
+        if authorized_user_id != user_id:
+            raise exceptions.UnauthorizedException(
+                "Not enough rights to search the user's messages!")
+        cur = get_read_connection().cursor()
+
+        after_key = None if after is None else db_utils.decode_cursor(after, [float, int])
+        messages = db_utils.search_messages(
+            cur, user_id, q, _page_limit(limit), after_key)
+        return _page(messages, limit, ["rank", "message_id"])
+
+    except exceptions.UnauthorizedException as e:
+        return e.description, e.code, e.authentication_header
+    except exceptions.ResponseException as e:
+        return e.description, e.code
+    finally:
+        if cur is not None:
+            cur.close()
+
+# user/{user_id}/unread --------------------------------------------------------
+def get_unread_count(user_id):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         authorized_user_id = _check_credentials(cur)
         if authorized_user_id != user_id:
             raise exceptions.UnauthorizedException(
                 "Not enough rights to access the user's received messages!")
 
-        messages = db_utils.get_sent_messages(cur, user_id)
-        return  messages, 200
+        unread = db_utils.get_unread_count(cur, user_id)
+        return {"unread": unread}, 200
+
+    except exceptions.UnauthorizedException as e:
+        return e.description, e.code, e.authentication_header
+    except exceptions.ResponseException as e:
+        return e.description, e.code
+    finally:
+        cur.close()
+
+# user/{user_id}/stream --------------------------------------------------------
+def stream_messages(user_id):
+    cur = get_connection().cursor()
+    try:
+        authorized_user_id = _check_credentials(cur)
+        if authorized_user_id != user_id:
+            raise exceptions.UnauthorizedException(
+                "Not enough rights to access the user's received messages!")
 
     except exceptions.UnauthorizedException as e:
         return e.description, e.code, e.authentication_header
@@ -219,16 +633,62 @@ def get_sent_messages(user_id):
     finally:
         cur.close()
 
+    def _generate(events):
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event, data = events.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "event: %s\ndata: %s\n\n" % (event, flask.json.dumps(data))
+        finally:
+            new_messages.unsubscribe(user_id, events)
+
+    # an open stream holds a thread, their number is capped (by gunicorn_conf)
+    # and an idle stream must not keep a database connection, the slot is
+    # released here on any failure until the response takes it over
+    limiter = stream_limiter
+    limiter.acquire()
+    events = None
+    try:
+        release_connection()
+        events = new_messages.subscribe(user_id)
+        response = flask.Response(
+            _generate(events),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.call_on_close(limiter.release)
+    except BaseException:
+        if events is not None:
+            new_messages.unsubscribe(user_id, events)
+        limiter.release()
+        raise
+    return response
+
 # message/{msg_id} -------------------------------------------------------------
 def get_message(message_id):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         user_id = _check_credentials(cur)
+
+        # the version is checked with the same read receipt as get_message,
+        # which is not needed again when the client has the message already
+        if "If-None-Match" in connexion.request.headers:
+            version = db_utils.get_message_version(cur, user_id, message_id)
+            not_modified = _not_modified(
+                db_utils.make_etag("message", message_id, version))
+            if not_modified is not None:
+                return not_modified
+
         result = db_utils.get_message(
             cursor=cur,
             user_id=user_id,
             message_id=message_id)
-        return result, 200
+        etag = db_utils.make_etag(
+            "message", message_id, db_utils.message_version(result))
+        return result, 200, _etag_header(etag)
 
     except exceptions.UnauthorizedException as e:
         return e.description, e.code, e.authentication_header
@@ -238,8 +698,8 @@ def get_message(message_id):
         cur.close()
 
 def delete_message(message_id):
+    cur = get_connection().cursor()
     try:
-        cur = get_connection().cursor()
         user_id = _check_credentials(cur)
         db_utils.delete_message(
             cursor=cur,
@@ -254,10 +714,72 @@ def delete_message(message_id):
     finally:
         cur.close()
 
+# jobs/{job_id} -----------------------------------------------------------------
+def get_job(job_id):
+    cur = get_connection().cursor()
+    try:
+        user_id = _check_credentials(cur)
+
+        job = db_utils.get_job(cur, job_id)
+        if job["sender_id"] != user_id:
+            raise exceptions.UnauthorizedException(
+                "Only the sender user can follow the delivery of the message")
+        return job, 200
+
+    except exceptions.UnauthorizedException as e:
+        return e.description, e.code, e.authentication_header
+    except exceptions.ResponseException as e:
+        return e.description, e.code
+    finally:
+        cur.close()
+
 #-------------------------------------------------------------------------------
 ################################################################################
 
+def _page_limit(limit):
+    # fetch one extra row to find out whether there is a next page
+    return None if limit is None else limit + 1
+
+def _page(rows, limit, keyset, etag=None):
+    """
+    Trim the serializer.Rows fetched with _page_limit to the page size, adding
+    the cursor of the next page (if any) in the X-Next-Cursor header.
+    """
+    headers = {} if etag is None else _etag_header(etag)
+    if limit is not None and len(rows) > limit:
+        del rows[limit:]
+        headers["X-Next-Cursor"] = db_utils.encode_cursor(
+            [rows.last(k) for k in keyset])
+    return flask.Response(
+        serializer.dumps(rows), mimetype="application/json", headers=headers)
+
+def _etag_header(etag):
+    return {"ETag": '"%s"' % etag}
+
+def _not_modified(etag):
+    """
+    Return a 304 response if the If-None-Match header of the request matches
+    the entity tag, None otherwise.
+    """
+    if not db_utils.etag_matches(
+        connexion.request.headers.get("If-None-Match"), etag):
+        return None
+    return flask.Response(status=304, headers=_etag_header(etag))
+
+def _stream_response(chunks, etag=None):
+    """
+    Stream the chunks of rows produced by a db_utils.stream_* function as a
+    JSON array, the request keeps its connection until the stream ends.
+    """
+    return flask.Response(
+        flask.stream_with_context(serializer.iter_dumps(chunks)),
+        mimetype="application/json",
+        headers=None if etag is None else _etag_header(etag))
+
+@metrics.AUTH_SECONDS.time()
 def _check_credentials(cursor=None):
+    # without a cursor (the read-only operations), the primary is queried: a
+    # lagging replica could still accept a password that was just changed
     auth = connexion.request.authorization
     headers = connexion.request.headers
 
@@ -267,6 +789,12 @@ def _check_credentials(cursor=None):
         raise exceptions.UnauthorizedException(
             "You must use Basic HTTP authentication to access this resource")
 
+    # recently verified credentials don't need a database round trip
+    user_id = credentials_cache.get(auth.username, auth.password)
+    if user_id is not None:
+        return user_id
+    generation = credentials_cache.generation()
+
     # query the database for user information
     cur = get_connection().cursor() if cursor is None else cursor
     user_ids = db_utils.query_users(
@@ -280,4 +808,7 @@ def _check_credentials(cursor=None):
     if len(user_ids) == 0:
         raise exceptions.UnauthorizedException(
             "Invalid authentication credentials!")
-    return user_ids[0]["user_id"]
\ No newline at end of file
+
+    user_id = user_ids[0]["user_id"]
+    credentials_cache.put(auth.username, auth.password, user_id, generation)
+    return user_id
\ No newline at end of file
@@ -1,6 +1,7 @@
 import psycopg2 as ps
 
 import db_utils
+import migrations
 
 def db_init(database_url):
     conn = ps.connect(database_url)
@@ -29,6 +30,9 @@ def db_init(database_url):
             message_read bool NOT NULL DEFAULT FALSE);''')
     conn.commit()
 
+    # bring the freshly created schema to the latest version
+    migrations.migrate(database_url)
+
     #---------------------------------------------------------------------------
     # Populate user table
 
@@ -0,0 +1,91 @@
+import collections
+import logging
+import select
+import threading
+import time
+
+import psycopg2 as ps
+
+logger = logging.getLogger(__name__)
+
+class Listener:
+    """
+    Background thread holding one dedicated connection that LISTENs on a set
+    of channels and dispatches every notification payload to the callbacks
+    subscribed to its channel.
+
+    Notifications sent while the connection is down are lost, so callbacks
+    registered with on_reconnect are invoked every time the connection is
+    re-established to let subscribers resynchronize.
+    """
+
+    def __init__(self, database_url:str, reconnect_delay:float=1.0):
+        self.database_url = database_url
+        self.reconnect_delay = reconnect_delay
+
+        self._callbacks = collections.defaultdict(list)
+        self._reconnect_callbacks = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, channel:str, callback):
+        """
+        Register callback(payload) for the given channel, must be called
+        before start().
+        """
+        if self._thread is not None:
+            raise RuntimeError("Cannot subscribe to a running listener")
+        self._callbacks[channel].append(callback)
+
+    def on_reconnect(self, callback):
+        self._reconnect_callbacks.append(callback)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="db-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    #---------------------------------------------------------------------------
+    def _run(self):
+        first_connection = True
+        while not self._stop.is_set():
+            connection = None
+            try:
+                connection = ps.connect(self.database_url)
+                connection.autocommit = True
+                with connection.cursor() as cur:
+                    for channel in self._callbacks:
+                        cur.execute("LISTEN " + channel + ";")
+
+                if not first_connection:
+                    for callback in self._reconnect_callbacks:
+                        self._call(callback)
+                first_connection = False
+
+                while not self._stop.is_set():
+                    if select.select([connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        for callback in self._callbacks[notify.channel]:
+                            self._call(callback, notify.payload)
+
+            except (ps.OperationalError, ps.InterfaceError):
+                first_connection = False
+                time.sleep(self.reconnect_delay)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def _call(self, callback, *args):
+        # a failing callback must neither stop the thread nor skip the others
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Listener callback %r failed", callback)
@@ -0,0 +1,155 @@
+import collections
+import threading
+import time
+
+import psycopg2 as ps
+
+import exceptions
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of psycopg2 connections.
+
+    Connections are opened lazily up to max_size, checked with a cheap query
+    when they have been idle for longer than health_check_interval and
+    transparently replaced when they turn out to be broken.
+    """
+
+    def __init__(
+        self,
+        database_url:str,
+        min_size:int=1,
+        max_size:int=10,
+        timeout:float=5.0,
+        health_check_interval:float=30.0,
+        cursor_factory=None):
+
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size (min_size=%d, max_size=%d)"
+                % (min_size, max_size))
+
+        self.database_url = database_url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.cursor_factory = cursor_factory
+
+        self._idle = collections.deque() # (connection, last_used) pairs
+        self._size = 0 # open connections, either idle or checked out
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    #---------------------------------------------------------------------------
+    def getconn(self) -> ps.extensions.connection:
+        """
+        Check out a healthy connection, waiting at most `timeout` seconds for
+        one to become available.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            connection, last_used = self._checkout(deadline)
+            if connection is None: # a free slot, open a brand new connection
+                try:
+                    return self._connect()
+                except exceptions.ResponseException:
+                    self._release_slot()
+                    raise
+
+            if self._is_healthy(connection, last_used):
+                return connection
+            self._discard(connection)
+
+    def putconn(self, connection:ps.extensions.connection, discard:bool=False):
+        """
+        Return a connection to the pool, rolling back any transaction left open.
+        """
+        if not discard and not connection.closed:
+            try:
+                if (connection.get_transaction_status() !=
+                    ps.extensions.TRANSACTION_STATUS_IDLE):
+                    connection.rollback()
+            except ps.Error:
+                discard = True
+        else:
+            discard = True
+
+        if discard or self._closed:
+            self._discard(connection)
+            return
+
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, collections.deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for connection, _ in idle:
+            connection.close()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"size": self._size,
+                    "idle": len(self._idle),
+                    "max_size": self.max_size}
+
+    #---------------------------------------------------------------------------
+    def _checkout(self, deadline):
+        # return an idle connection or (None, None) if a new one can be opened
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise exceptions.ServiceUnavailableException(
+                        "The database connection pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise exceptions.ServiceUnavailableException(
+                        "No database connection available, retry later")
+                self._cond.wait(remaining)
+
+    def _connect(self):
+        try:
+            return ps.connect(self.database_url, cursor_factory=self.cursor_factory)
+        except ps.OperationalError:
+            raise exceptions.ServiceUnavailableException(
+                "Unable to connect to the database, retry later")
+
+    def _is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except (ps.OperationalError, ps.InterfaceError):
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except ps.Error:
+            pass
+        self._release_slot()
+
+    def _release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
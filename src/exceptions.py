@@ -20,4 +20,14 @@ class NotFoundException(ResponseException):
 
 class ConflictException(ResponseException):
     def __init__(self, description="Resource conflict!"):
-        super().__init__(409, description)
\ No newline at end of file
+        super().__init__(409, description)
+
+class ServiceUnavailableException(ResponseException):
+    def __init__(self, description="Service temporarily unavailable!", retry_after=1):
+        super().__init__(503, description)
+        self.retry_after_header = {'Retry-After': str(retry_after)}
+
+class TooManyRequestsException(ResponseException):
+    def __init__(self, description="Too many requests!", retry_after=1):
+        super().__init__(429, description)
+        self.retry_after_header = {'Retry-After': str(retry_after)}
@@ -0,0 +1,47 @@
+# gunicorn configuration of the production server:
+#   gunicorn --config src/gunicorn_conf.py --chdir src wsgi:application
+# Send HUP to the master to gracefully replace the workers with new ones
+# running the current code.
+import multiprocessing
+import os
+
+bind = "0.0.0.0:" + os.environ.get('PORT', '8080')
+
+# pre-forked worker processes, each one serving requests on a thread pool
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.environ.get('WEB_THREADS', 4))
+
+# an open event stream (user/{user_id}/stream) holds a thread of the worker
+# until the client leaves, so that a worker only opens that many of them and
+# turns the others down with a 503 to keep threads for the other requests (the
+# aiohttp server of `main.py --async` serves the streams without threads)
+max_streams = int(os.environ.get('WEB_MAX_STREAMS', max(1, threads // 2)))
+
+# recycle the workers after a number of requests (with some jitter so that
+# they don't restart all together)
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+graceful_timeout = 30
+timeout = 30
+
+# the application is loaded by each worker, so that HUP reloads the code too
+preload_app = False
+
+def post_fork(server, worker):
+    # connections, pool and listener thread must not be shared with the parent
+    import controller
+    import db_utils
+    import main
+
+    # no more operations at once than threads
+    controller.connect(
+        db_url=os.environ.get('DATABASE_URL', db_utils.DEFAULT_DB),
+        threads=threads,
+        max_streams=max_streams,
+        **main.pool_config())
+
+def worker_exit(server, worker):
+    import controller
+    controller.close_connection()
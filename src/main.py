@@ -7,18 +7,76 @@ import psycopg2 as ps
 import connexion
 
 # custom modules
+import admission
 import controller
 import db_utils
+import exceptions
 
 
 
-def main(debug, port_number):
+def create_app(debug):
+    """
+    Build the connexion application, the database connections are opened
+    separately by controller.connect (see also wsgi.py).
+    """
     app = connexion.App(__name__, specification_dir='../', debug=debug)
     app.add_api(
         'swagger.yml',
         strict_validation=True,
         #validate_responses=True,
+        resolver=connexion.Resolver(controller.resolve),
         arguments={'title': 'Cloud Computing Exercise 2'})
+
+    # every request checks out its own pooled connection, give it back at the end
+    app.app.teardown_appcontext(controller.release_connection)
+    app.app.after_request(controller.add_session_lsn)
+    app.add_error_handler(
+        exceptions.ServiceUnavailableException,
+        controller.handle_retry_later)
+    app.add_error_handler(
+        exceptions.TooManyRequestsException,
+        controller.handle_retry_later)
+    return app
+
+def pool_config():
+    """
+    Connection pool configuration from the environment.
+    """
+    return {
+        "min_size": int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+        "max_size": int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+        "timeout": float(os.environ.get('DB_POOL_TIMEOUT', 5.0)),
+        "auth_cache_size": int(os.environ.get('AUTH_CACHE_SIZE', 10000)),
+        "auth_cache_ttl": float(os.environ.get('AUTH_CACHE_TTL', 60.0)),
+        "slow_query_ms": float(os.environ.get('SLOW_QUERY_MS', 1000)),
+        "body_compress_min_size": int(os.environ.get('BODY_COMPRESS_MIN_SIZE', 256)),
+        "replica_urls": [url for url in
+            os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url],
+        "rate_limits": (admission.parse_limits(os.environ['RATE_LIMITS'])
+            if 'RATE_LIMITS' in os.environ else None),
+        "max_concurrent": (int(os.environ['MAX_CONCURRENT_REQUESTS'])
+            if 'MAX_CONCURRENT_REQUESTS' in os.environ else None),
+        "admission_timeout": float(os.environ.get('ADMISSION_TIMEOUT', 0.1))}
+
+def main(debug, port_number):
+    app = create_app(debug)
+    app.run(port=port_number)
+
+def main_async(debug, port_number, database_url, pool_config):
+    """
+    Serve the same API on aiohttp, with an aiopg pool instead of psycopg2.
+    """
+    # optional dependencies, only needed by the async serving mode
+    import async_controller
+
+    app = connexion.AioHttpApp(__name__, specification_dir='../', debug=debug)
+    app.add_api(
+        'swagger.yml',
+        strict_validation=True,
+        arguments={'title': 'Cloud Computing Exercise 2'},
+        resolver=connexion.Resolver(async_controller.resolve),
+        pass_context_arg_name='request')
+    async_controller.setup(app.app, db_url=database_url, **pool_config)
     app.run(port=port_number)
 
 
@@ -40,12 +98,25 @@ if __name__ == '__main__':
     else:
         debug=False
 
+    # check if server runs on asyncio (parameter --async)
+    if "--async" in arg_set:
+        arg_set.remove("--async")
+        run_async = True
+    else:
+        run_async = False
+
     # check if other falgs are passed to the script, if so return usage
     if len(arg_set) != 0:
-        print("Wrong synthax, usage: main.py [--debug][--heroku]")
+        print("Wrong synthax, usage: main.py [--debug][--heroku][--async]")
+    elif run_async:
+        main_async(debug=debug,
+                   port_number=port_number,
+                   database_url=database_url,
+                   pool_config=pool_config())
+        print('REST API server closed successfully!')
     else: # otherwise run the application
         try:
-            controller.connect(db_url=database_url)
+            controller.connect(db_url=database_url, **pool_config())
             main(debug=debug,
                  port_number=port_number)
         finally:
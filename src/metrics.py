@@ -0,0 +1,336 @@
+import asyncio
+import bisect
+import functools
+import logging
+import sys
+import threading
+import time
+
+import psycopg2 as ps
+import psycopg2.extensions
+
+import exceptions
+
+# In-process metrics exposed on /metrics in the Prometheus text format: the
+# latency of the operations and of the database statements, the row counts,
+# the response codes, the connection pool waits and the credentials cache
+# lookups. Each process (e.g. each
+# gunicorn worker) has its own values.
+
+logger = logging.getLogger(__name__)
+
+# statements slower than this (in seconds) are logged, None to disable
+slow_query_seconds = 1.0
+
+# latency buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+class _Metric:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _samples(self):
+        # (suffix, labels, value) of the samples of the metric
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self._samples():
+            lines.append("%s%s%s %s" % (
+                self.name, suffix, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines)
+
+class Counter(_Metric):
+    """
+    Counter incremented by inc, or read when rendering from a function
+    returning {labels: value} (counted elsewhere) if collect is set.
+    """
+    type = "counter"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def _samples(self):
+        if self.collect is not None:
+            values = sorted(self.collect().items())
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [("_total", zip(self.labels, k), v) for k, v in values]
+
+class Gauge(_Metric):
+    """
+    Gauge read when rendering from a function returning {labels: value}.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def _samples(self):
+        values = {} if self.collect is None else self.collect()
+        return [("", zip(self.labels, k), v) for k, v in sorted(values.items())]
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, labels=()):
+        """
+        Decorator observing the duration of the calls of a function (or of a
+        coroutine function).
+        """
+        def decorator(f):
+            if asyncio.iscoroutinefunction(f):
+                @functools.wraps(f)
+                async def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await f(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, labels)
+            else:
+                @functools.wraps(f)
+                def wrapper(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return f(*args, **kwargs)
+                    finally:
+                        self.observe(time.perf_counter() - start, labels)
+            return wrapper
+        return decorator
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        samples = []
+        for labels, counts in values:
+            labels = list(zip(self.labels, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append(
+                    ("_bucket", labels + [("le", _format_value(bound))], cumulative))
+            samples.append(("_sum", labels, counts[-1]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+def _format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\")
+        .replace('"', '\\"').replace("\n", "\\n")) for k, v in labels) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render() -> str:
+    """
+    Return all the metrics in the Prometheus text format.
+    """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+#-------------------------------------------------------------------------------
+REQUEST_SECONDS = Histogram(
+    "messenger_request_duration_seconds",
+    "Duration of the API operations", ["operation"])
+RESPONSES = Counter(
+    "messenger_responses",
+    "Responses of the API operations by status code", ["operation", "code"])
+AUTH_SECONDS = Histogram(
+    "messenger_auth_duration_seconds",
+    "Duration of the credentials checks")
+QUERY_SECONDS = Histogram(
+    "messenger_db_query_duration_seconds",
+    "Duration of the database statements by calling function", ["statement"])
+QUERY_ROWS = Counter(
+    "messenger_db_query_rows",
+    "Rows returned or affected by the database statements", ["statement"])
+QUERY_ERRORS = Counter(
+    "messenger_db_query_errors",
+    "Failed database statements by SQLSTATE", ["statement", "sqlstate"])
+POOL_WAIT_SECONDS = Histogram(
+    "messenger_db_pool_wait_seconds",
+    "Time spent waiting for a database connection")
+POOL_CONNECTIONS = Gauge(
+    "messenger_db_pool_connections",
+    "Connections of the pool by state", ["state"])
+READ_ROUTING = Counter(
+    "messenger_db_read_routing",
+    "Read-only operations by database serving them", ["target"])
+AUTH_CACHE_LOOKUPS = Counter(
+    "messenger_auth_cache_lookups",
+    "Lookups of the credentials cache by result", ["result"])
+AUTH_CACHE_EVICTIONS = Counter(
+    "messenger_auth_cache_evictions",
+    "Credentials evicted from the full credentials cache")
+AUTH_CACHE_ENTRIES = Gauge(
+    "messenger_auth_cache_entries",
+    "Credentials in the cache and its maximum size", ["state"])
+
+def collect_auth_cache(cache):
+    """
+    Read the credentials cache metrics from the counters of the given
+    auth_cache.CredentialCache.
+    """
+    AUTH_CACHE_LOOKUPS.collect = lambda: {
+        ("hit",): cache.stats()["hits"], ("miss",): cache.stats()["misses"]}
+    AUTH_CACHE_EVICTIONS.collect = lambda: {(): cache.stats()["evictions"]}
+    AUTH_CACHE_ENTRIES.collect = lambda: {
+        ("size",): cache.stats()["size"], ("max",): cache.stats()["max_size"]}
+
+def instrument(operation):
+    """
+    Decorator recording the duration and the response code of an operation
+    (a controller function or coroutine function).
+    """
+    def decorator(f):
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                code = 500
+                try:
+                    response = await f(*args, **kwargs)
+                    code = _status(response)
+                    return response
+                except exceptions.ResponseException as e:
+                    code = e.code
+                    raise
+                finally:
+                    _record(operation, code, time.perf_counter() - start)
+        else:
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                code = 500
+                try:
+                    response = f(*args, **kwargs)
+                    code = _status(response)
+                    return response
+                except exceptions.ResponseException as e:
+                    code = e.code
+                    raise
+                finally:
+                    _record(operation, code, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def _status(response):
+    # status of the (body, status[, headers]) tuples or of the response objects
+    if isinstance(response, tuple):
+        return response[1] if len(response) > 1 else 200
+    return getattr(response, "status_code", getattr(response, "status", 200))
+
+def _record(operation, code, duration):
+    REQUEST_SECONDS.observe(duration, (operation,))
+    RESPONSES.inc((operation, str(code)))
+
+#-------------------------------------------------------------------------------
+# modules executing statements on behalf of their caller
+_SKIPPED_MODULES = (__name__, "prepared")
+
+def _statement():
+    # name of the function that executed the statement, skipping the frames
+    # of psycopg2 (e.g. extras.execute_values) and of _SKIPPED_MODULES
+    frame = sys._getframe(2)
+    while frame is not None and (
+        frame.f_globals.get("__name__", "").startswith("psycopg2") or
+        frame.f_globals.get("__name__") in _SKIPPED_MODULES):
+        frame = frame.f_back
+    return "unknown" if frame is None else frame.f_code.co_name
+
+def _observe_query(statement, duration, rowcount, query):
+    QUERY_SECONDS.observe(duration, (statement,))
+    if rowcount > 0:
+        QUERY_ROWS.inc((statement,), rowcount)
+    if slow_query_seconds is not None and duration >= slow_query_seconds:
+        if isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+        logger.warning("slow query in %s (%.1f ms): %s",
+            statement, duration * 1000, " ".join(str(query).split())[:1000])
+
+class InstrumentedCursor(ps.extensions.cursor):
+    """
+    Cursor class (the cursor_factory of the pooled connections) observing
+    the duration, the row count and the errors of every statement.
+    """
+
+    def execute(self, query, vars=None):
+        statement = _statement()
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        except ps.Error as e:
+            QUERY_ERRORS.inc((statement, e.pgcode or "none"))
+            raise
+        finally:
+            _observe_query(
+                statement, time.perf_counter() - start, self.rowcount, self.query)
+
+    def executemany(self, query, vars_list):
+        statement = _statement()
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        except ps.Error as e:
+            QUERY_ERRORS.inc((statement, e.pgcode or "none"))
+            raise
+        finally:
+            _observe_query(
+                statement, time.perf_counter() - start, self.rowcount, self.query)
+
+class InstrumentedAsyncCursor:
+    """
+    Same as InstrumentedCursor for the aiopg cursors, which it wraps.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    async def execute(self, query, parameters=None, **kwargs):
+        statement = _statement()
+        start = time.perf_counter()
+        try:
+            return await self._cursor.execute(query, parameters, **kwargs)
+        except ps.Error as e:
+            QUERY_ERRORS.inc((statement, e.pgcode or "none"))
+            raise
+        finally:
+            _observe_query(statement, time.perf_counter() - start,
+                self._cursor.rowcount, self._cursor.query)
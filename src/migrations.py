@@ -0,0 +1,748 @@
+import collections
+
+import psycopg2 as ps
+import psycopg2.extras
+
+import bodies
+import db_utils
+
+# Schema migrations, applied in order of version on top of the tables created
+# by db_init (version 0). Each step is either a SQL string or a function taking
+# a cursor. Migrations are applied in a single transaction unless they are
+# marked as non transactional (e.g. CREATE INDEX CONCURRENTLY), in which case
+# their steps must be idempotent since a failure may leave them half applied.
+# Never edit a migration that has already been released, add a new one instead.
+Migration = collections.namedtuple(
+    "Migration", ["version", "description", "steps", "transactional"])
+
+def _index_compressed_bodies(cursor, batch_size=1000):
+    # the compressed bodies are decompressed here, in batches of body hashes
+    after = b""
+    while True:
+        cursor.execute(
+            '''
+            SELECT body_hash, body FROM MessageBodies
+            WHERE compressed AND body_hash > %s
+            ORDER BY body_hash
+            LIMIT %s;''', [after, batch_size])
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        ps.extras.execute_values(
+            cursor,
+            '''
+            UPDATE MessageBodies as b
+            SET search_vector = to_tsvector('simple', v.text)
+            FROM (VALUES %s) as v (body_hash, text)
+            WHERE b.body_hash = v.body_hash;''',
+            [(body_hash, bodies.decode(True, body)) for body_hash, body in rows],
+            template="(%s::bytea, %s)")
+        after = bytes(rows[-1][0])
+
+MIGRATIONS = [
+    Migration(1, "Primary key on Receivers(message_id, receiver_id)", [
+        # merge duplicated receivers, keeping the read flag if any copy has it
+        '''
+        UPDATE Receivers as r
+        SET message_read = TRUE
+        WHERE NOT r.message_read AND EXISTS (
+            SELECT 1 FROM Receivers as d
+            WHERE d.message_id = r.message_id
+                AND d.receiver_id = r.receiver_id
+                AND d.message_read);''',
+        '''
+        DELETE FROM Receivers as a
+        USING Receivers as b
+        WHERE a.ctid < b.ctid
+            AND a.message_id = b.message_id
+            AND a.receiver_id = b.receiver_id;''',
+        '''
+        ALTER TABLE Receivers
+        ADD CONSTRAINT receivers_pkey PRIMARY KEY (message_id, receiver_id);''',
+        ], True),
+
+    Migration(2, "Indexes on Receivers(receiver_id) and Messages(sender_id)", [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS receivers_receiver_id_idx
+        ON Receivers (receiver_id, message_id);''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_sender_id_idx
+        ON Messages (sender_id, timestamp, message_id);''',
+        ], False),
+
+    Migration(3, "Broadcasts stored once and merged into the inboxes on read", [
+        '''
+        ALTER TABLE Messages
+        ADD COLUMN broadcast bool NOT NULL DEFAULT FALSE;''',
+        # users registered before this migration received the old broadcasts
+        # as regular Receivers rows, so they are eligible to any new broadcast
+        '''
+        ALTER TABLE Users
+        ADD COLUMN created_at timestamp with time zone NOT NULL DEFAULT '-infinity';''',
+        '''
+        ALTER TABLE Users
+        ALTER COLUMN created_at SET DEFAULT current_timestamp;''',
+        ], True),
+
+    Migration(4, "Partial index on broadcast messages", [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_broadcast_idx
+        ON Messages (timestamp, message_id) WHERE broadcast;''',
+        ], False),
+
+    Migration(5, "Queue of the deferred message deliveries", [
+        '''
+        CREATE TABLE SendJobs (
+            job_id serial PRIMARY KEY,
+            message_id int NOT NULL REFERENCES Messages ON DELETE CASCADE,
+            sender_id int NOT NULL REFERENCES Users,
+            receiver_ids int[] NOT NULL,
+            delivered int NOT NULL DEFAULT 0,
+            status varchar(16) NOT NULL DEFAULT 'queued',
+            error text,
+            created_at timestamp with time zone NOT NULL DEFAULT current_timestamp,
+            updated_at timestamp with time zone NOT NULL DEFAULT current_timestamp);''',
+        '''
+        CREATE INDEX sendjobs_pending_idx
+        ON SendJobs (job_id) WHERE status IN ('queued', 'running');''',
+        '''
+        CREATE INDEX sendjobs_message_id_idx ON SendJobs (message_id);''',
+        ], True),
+
+    Migration(6, "Unread counters maintained by triggers on Receivers", [
+        # block writes on Receivers until the counters are backfilled
+        "LOCK TABLE Receivers IN SHARE ROW EXCLUSIVE MODE;",
+        '''
+        CREATE TABLE Mailboxes (
+            user_id int PRIMARY KEY REFERENCES Users ON DELETE CASCADE,
+            unread int NOT NULL DEFAULT 0);''',
+        # statement level triggers, so that a multi-row insert of the receivers
+        # updates each counter once (in user-id order to avoid deadlocks)
+        '''
+        CREATE FUNCTION mailboxes_add_unread() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO Mailboxes (user_id, unread)
+                SELECT receiver_id, count(*)
+                FROM new_receivers
+                WHERE NOT message_read
+                GROUP BY receiver_id
+                ORDER BY receiver_id
+            ON CONFLICT (user_id) DO UPDATE
+                SET unread = Mailboxes.unread + EXCLUDED.unread;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE FUNCTION mailboxes_update_unread() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Mailboxes as b
+            SET unread = b.unread + d.delta
+            FROM (
+                SELECT n.receiver_id,
+                    sum(CASE WHEN n.message_read THEN -1 ELSE 1 END) as delta
+                FROM new_receivers as n, old_receivers as o
+                WHERE n.message_id = o.message_id
+                    AND n.receiver_id = o.receiver_id
+                    AND n.message_read <> o.message_read
+                GROUP BY n.receiver_id
+                ORDER BY n.receiver_id) as d
+            WHERE b.user_id = d.receiver_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE FUNCTION mailboxes_remove_unread() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Mailboxes as b
+            SET unread = b.unread - d.removed
+            FROM (
+                SELECT receiver_id, count(*) as removed
+                FROM old_receivers
+                WHERE NOT message_read
+                GROUP BY receiver_id
+                ORDER BY receiver_id) as d
+            WHERE b.user_id = d.receiver_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE TRIGGER receivers_insert_unread
+        AFTER INSERT ON Receivers
+        REFERENCING NEW TABLE AS new_receivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_add_unread();''',
+        '''
+        CREATE TRIGGER receivers_update_unread
+        AFTER UPDATE ON Receivers
+        REFERENCING OLD TABLE AS old_receivers NEW TABLE AS new_receivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_update_unread();''',
+        '''
+        CREATE TRIGGER receivers_delete_unread
+        AFTER DELETE ON Receivers
+        REFERENCING OLD TABLE AS old_receivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_remove_unread();''',
+        '''
+        INSERT INTO Mailboxes (user_id, unread)
+            SELECT receiver_id, count(*) FILTER (WHERE NOT message_read)
+            FROM Receivers
+            GROUP BY receiver_id;''',
+        ], True),
+
+    Migration(7, "Versions of the listings, validators of the conditional requests", [
+        "LOCK TABLE Receivers, Messages IN SHARE ROW EXCLUSIVE MODE;",
+        # received mailbox version, bumped with the unread counters
+        '''
+        ALTER TABLE Mailboxes
+        ADD COLUMN version bigint NOT NULL DEFAULT 0;''',
+        '''
+        CREATE OR REPLACE FUNCTION mailboxes_add_unread() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO Mailboxes (user_id, unread, version)
+                SELECT receiver_id, count(*) FILTER (WHERE NOT message_read), 1
+                FROM new_receivers
+                GROUP BY receiver_id
+                ORDER BY receiver_id
+            ON CONFLICT (user_id) DO UPDATE
+                SET unread = Mailboxes.unread + EXCLUDED.unread,
+                    version = Mailboxes.version + 1;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE OR REPLACE FUNCTION mailboxes_update_unread() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Mailboxes as b
+            SET unread = b.unread + d.delta,
+                version = b.version + 1
+            FROM (
+                SELECT n.receiver_id,
+                    sum(CASE WHEN n.message_read THEN -1 ELSE 1 END) as delta
+                FROM new_receivers as n, old_receivers as o
+                WHERE n.message_id = o.message_id
+                    AND n.receiver_id = o.receiver_id
+                    AND n.message_read <> o.message_read
+                GROUP BY n.receiver_id
+                ORDER BY n.receiver_id) as d
+            WHERE b.user_id = d.receiver_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE OR REPLACE FUNCTION mailboxes_remove_unread() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Mailboxes as b
+            SET unread = b.unread - d.removed,
+                version = b.version + 1
+            FROM (
+                SELECT receiver_id,
+                    count(*) FILTER (WHERE NOT message_read) as removed
+                FROM old_receivers
+                GROUP BY receiver_id
+                ORDER BY receiver_id) as d
+            WHERE b.user_id = d.receiver_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        INSERT INTO Mailboxes (user_id)
+            SELECT DISTINCT receiver_id FROM Receivers
+        ON CONFLICT (user_id) DO NOTHING;''',
+        # sent mailbox versions, kept apart from Mailboxes so that a sender
+        # never waits on its receivers' counters
+        '''
+        CREATE TABLE Outboxes (
+            user_id int PRIMARY KEY REFERENCES Users ON DELETE CASCADE,
+            version bigint NOT NULL DEFAULT 0);''',
+        # versions of the user list and of the broadcasts (part of every inbox)
+        '''
+        CREATE TABLE Versions (
+            name varchar(32) PRIMARY KEY,
+            version bigint NOT NULL DEFAULT 0);''',
+        "INSERT INTO Versions (name) VALUES ('users'), ('broadcasts');",
+        '''
+        CREATE FUNCTION outboxes_add_messages() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO Outboxes (user_id, version)
+                SELECT DISTINCT sender_id, 1
+                FROM new_messages
+                ORDER BY sender_id
+            ON CONFLICT (user_id) DO UPDATE
+                SET version = Outboxes.version + 1;
+            IF EXISTS (SELECT 1 FROM new_messages WHERE broadcast) THEN
+                UPDATE Versions SET version = version + 1 WHERE name = 'broadcasts';
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        # before the deletion, so that the sender is locked before the
+        # receivers deleted by the cascade (same order as when sending)
+        '''
+        CREATE FUNCTION outboxes_remove_message() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Outboxes SET version = version + 1 WHERE user_id = OLD.sender_id;
+            IF OLD.broadcast THEN
+                UPDATE Versions SET version = version + 1 WHERE name = 'broadcasts';
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE FUNCTION versions_bump_users() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Versions SET version = version + 1 WHERE name = 'users';
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE TRIGGER messages_insert_outbox
+        AFTER INSERT ON Messages
+        REFERENCING NEW TABLE AS new_messages
+        FOR EACH STATEMENT EXECUTE PROCEDURE outboxes_add_messages();''',
+        '''
+        CREATE TRIGGER messages_delete_outbox
+        BEFORE DELETE ON Messages
+        FOR EACH ROW EXECUTE PROCEDURE outboxes_remove_message();''',
+        '''
+        CREATE TRIGGER users_change_version
+        AFTER INSERT OR DELETE OR UPDATE OF username ON Users
+        FOR EACH STATEMENT EXECUTE PROCEDURE versions_bump_users();''',
+        '''
+        INSERT INTO Outboxes (user_id)
+            SELECT DISTINCT sender_id FROM Messages;''',
+        ], True),
+
+    # see bodies.py, the existing texts are stored uncompressed (requires
+    # PostgreSQL 11 for sha256), the space of the dropped column is reclaimed
+    # when the rows are rewritten (e.g. VACUUM FULL Messages)
+    Migration(8, "Content-addressed message bodies", [
+        '''
+        CREATE TABLE MessageBodies (
+            body_hash bytea PRIMARY KEY,
+            compressed bool NOT NULL,
+            body bytea NOT NULL);''',
+        '''
+        INSERT INTO MessageBodies (body_hash, compressed, body)
+            SELECT sha256(convert_to(message_text, 'UTF8')), FALSE,
+                convert_to(message_text, 'UTF8')
+            FROM Messages
+            ON CONFLICT (body_hash) DO NOTHING;''',
+        '''
+        ALTER TABLE Messages
+        ADD COLUMN body_hash bytea REFERENCES MessageBodies;''',
+        '''
+        UPDATE Messages
+        SET body_hash = sha256(convert_to(message_text, 'UTF8'));''',
+        '''
+        ALTER TABLE Messages
+        ALTER COLUMN body_hash SET NOT NULL,
+        DROP COLUMN message_text;''',
+        # the references are checked when removing the unused bodies
+        '''
+        CREATE INDEX messages_body_hash_idx
+        ON Messages (body_hash);''',
+        ], True),
+
+    # Messages and Receivers are rebuilt as tables partitioned by month (in
+    # UTC) of the message timestamp, which Receivers gets a copy of, so that
+    # retention.py can archive the old months by detaching their partitions.
+    # The unique keys of partitioned tables include the partition key, the
+    # message-ids stay unique through their sequence. Requires PostgreSQL 13
+    # (BEFORE row triggers on partitioned tables).
+    Migration(9, "Messages and Receivers partitioned by month", [
+        "LOCK TABLE Messages, Receivers, SendJobs IN ACCESS EXCLUSIVE MODE;",
+        "ALTER TABLE Messages RENAME TO messages_unpartitioned;",
+        "ALTER TABLE Receivers RENAME TO receivers_unpartitioned;",
+        # the sequence would be dropped with the old table
+        "ALTER SEQUENCE messages_message_id_seq OWNED BY NONE;",
+        '''
+        CREATE TABLE Messages (
+            message_id int NOT NULL DEFAULT nextval('messages_message_id_seq'),
+            sender_id int NOT NULL REFERENCES Users,
+            timestamp timestamp with time zone NOT NULL,
+            broadcast bool NOT NULL DEFAULT FALSE,
+            body_hash bytea NOT NULL REFERENCES MessageBodies)
+        PARTITION BY RANGE (timestamp);''',
+        '''
+        CREATE TABLE Receivers (
+            message_id int NOT NULL,
+            receiver_id int NOT NULL REFERENCES Users,
+            message_read bool NOT NULL DEFAULT FALSE,
+            timestamp timestamp with time zone NOT NULL)
+        PARTITION BY RANGE (timestamp);''',
+        # rows outside of the monthly partitions, which must stay empty for
+        # the partitions of their months to be created
+        "CREATE TABLE messages_default PARTITION OF Messages DEFAULT;",
+        "CREATE TABLE receivers_default PARTITION OF Receivers DEFAULT;",
+        # partitions messages_pYYYYMM and receivers_pYYYYMM of the months from
+        # first_month to last_month, return how many months were created
+        '''
+        CREATE FUNCTION create_message_partitions(first_month date, last_month date)
+        RETURNS int AS $$
+        DECLARE
+            month date := date_trunc('month', first_month);
+            created int := 0;
+            suffix text;
+            lower_bound timestamp with time zone;
+            upper_bound timestamp with time zone;
+        BEGIN
+            WHILE month <= last_month LOOP
+                suffix := to_char(month, 'YYYYMM');
+                lower_bound := month::timestamp AT TIME ZONE 'UTC';
+                upper_bound := (month + interval '1 month') AT TIME ZONE 'UTC';
+                IF to_regclass('messages_p' || suffix) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF Messages FOR VALUES FROM (%L) TO (%L)',
+                        'messages_p' || suffix, lower_bound, upper_bound);
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF Receivers FOR VALUES FROM (%L) TO (%L)',
+                        'receivers_p' || suffix, lower_bound, upper_bound);
+                    created := created + 1;
+                END IF;
+                month := month + interval '1 month';
+            END LOOP;
+            RETURN created;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        SELECT create_message_partitions(
+            (COALESCE(min(timestamp), current_timestamp) AT TIME ZONE 'UTC')::date,
+            ((current_timestamp + interval '3 months') AT TIME ZONE 'UTC')::date)
+        FROM messages_unpartitioned;''',
+        '''
+        INSERT INTO Messages (message_id, sender_id, timestamp, broadcast, body_hash)
+            SELECT message_id, sender_id, timestamp, broadcast, body_hash
+            FROM messages_unpartitioned;''',
+        '''
+        INSERT INTO Receivers (message_id, receiver_id, message_read, timestamp)
+            SELECT r.message_id, r.receiver_id, r.message_read, m.timestamp
+            FROM receivers_unpartitioned as r, messages_unpartitioned as m
+            WHERE m.message_id = r.message_id;''',
+        '''
+        ALTER TABLE SendJobs
+        ADD COLUMN message_timestamp timestamp with time zone;''',
+        '''
+        UPDATE SendJobs as j
+        SET message_timestamp = m.timestamp
+        FROM messages_unpartitioned as m
+        WHERE m.message_id = j.message_id;''',
+        '''
+        ALTER TABLE SendJobs
+        ALTER COLUMN message_timestamp SET NOT NULL;''',
+        # along with their constraints, indexes and triggers
+        "DROP TABLE receivers_unpartitioned, messages_unpartitioned CASCADE;",
+        "ALTER SEQUENCE messages_message_id_seq OWNED BY Messages.message_id;",
+        '''
+        ALTER TABLE Messages
+        ADD CONSTRAINT messages_pkey PRIMARY KEY (message_id, timestamp);''',
+        '''
+        ALTER TABLE Receivers
+        ADD CONSTRAINT receivers_pkey PRIMARY KEY (message_id, receiver_id, timestamp),
+        ADD FOREIGN KEY (message_id, timestamp)
+            REFERENCES Messages ON DELETE CASCADE;''',
+        '''
+        ALTER TABLE SendJobs
+        ADD FOREIGN KEY (message_id, message_timestamp)
+            REFERENCES Messages ON DELETE CASCADE;''',
+        '''
+        CREATE INDEX receivers_receiver_id_idx
+        ON Receivers (receiver_id, message_id);''',
+        '''
+        CREATE INDEX messages_sender_id_idx
+        ON Messages (sender_id, timestamp, message_id);''',
+        '''
+        CREATE INDEX messages_broadcast_idx
+        ON Messages (timestamp, message_id) WHERE broadcast;''',
+        '''
+        CREATE INDEX messages_body_hash_idx
+        ON Messages (body_hash);''',
+        '''
+        CREATE TRIGGER receivers_insert_unread
+        AFTER INSERT ON Receivers
+        REFERENCING NEW TABLE AS new_receivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_add_unread();''',
+        '''
+        CREATE TRIGGER receivers_update_unread
+        AFTER UPDATE ON Receivers
+        REFERENCING OLD TABLE AS old_receivers NEW TABLE AS new_receivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_update_unread();''',
+        '''
+        CREATE TRIGGER receivers_delete_unread
+        AFTER DELETE ON Receivers
+        REFERENCING OLD TABLE AS old_receivers
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_remove_unread();''',
+        '''
+        CREATE TRIGGER messages_insert_outbox
+        AFTER INSERT ON Messages
+        REFERENCING NEW TABLE AS new_messages
+        FOR EACH STATEMENT EXECUTE PROCEDURE outboxes_add_messages();''',
+        '''
+        CREATE TRIGGER messages_delete_outbox
+        BEFORE DELETE ON Messages
+        FOR EACH ROW EXECUTE PROCEDURE outboxes_remove_message();''',
+        "ANALYZE Messages, Receivers;",
+        ], True),
+
+    # the texts are indexed once per body, from the text given to the insert
+    # since the compressed bodies cannot be read in SQL (see db_utils._body)
+    Migration(10, "Full-text search of the message bodies", [
+        '''
+        ALTER TABLE MessageBodies
+        ADD COLUMN search_vector tsvector;''',
+        '''
+        UPDATE MessageBodies
+        SET search_vector = to_tsvector('simple', convert_from(body, 'UTF8'))
+        WHERE NOT compressed;''',
+        _index_compressed_bodies,
+        '''
+        ALTER TABLE MessageBodies
+        ALTER COLUMN search_vector SET NOT NULL;''',
+        '''
+        CREATE INDEX messagebodies_search_vector_idx
+        ON MessageBodies USING gin (search_vector);''',
+        "ANALYZE MessageBodies;",
+        ], True),
+
+    # the unread broadcasts of a user are the broadcasts (counted by the
+    # 'broadcast_count' row of Versions) but those sent before the user signed
+    # up, and those the user sent or opened (i.e. has a receiver row of), the
+    # last two being counted in Mailboxes so that the unread count is read from
+    # single rows. The sign ups wait for the broadcasts being sent (through the
+    # lock of the counter) so that the broadcasts before them are all counted.
+    Migration(11, "Broadcast counters of the unread counts", [
+        "LOCK TABLE Users, Messages, Receivers IN SHARE ROW EXCLUSIVE MODE;",
+        '''
+        ALTER TABLE Mailboxes
+        ADD COLUMN broadcasts_before int NOT NULL DEFAULT 0,
+        ADD COLUMN broadcasts_opened int NOT NULL DEFAULT 0;''',
+        # the users who signed up after a broadcast, when it is sent or removed
+        '''
+        CREATE INDEX users_created_at_idx
+        ON Users (created_at);''',
+        '''
+        INSERT INTO Versions (name, version)
+            SELECT 'broadcast_count', count(*)
+            FROM Messages
+            WHERE broadcast;''',
+        # the broadcasts before each new user, counted in a single pass over
+        # the broadcasts and the users in timestamp order
+        '''
+        CREATE FUNCTION mailboxes_add_users() RETURNS trigger AS $$
+        BEGIN
+            PERFORM 1 FROM Versions WHERE name = 'broadcast_count' FOR SHARE;
+            INSERT INTO Mailboxes (user_id, broadcasts_before)
+                SELECT user_id, before
+                FROM (
+                    SELECT user_id, count(*) FILTER (WHERE user_id IS NULL) OVER (
+                        ORDER BY timestamp, user_id IS NULL
+                        ROWS UNBOUNDED PRECEDING) as before
+                    FROM (
+                        SELECT user_id, created_at as timestamp FROM new_users
+                        UNION ALL
+                        SELECT NULL, timestamp FROM Messages WHERE broadcast) as e
+                    ) as c
+                WHERE user_id IS NOT NULL
+                ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE
+                SET broadcasts_before = EXCLUDED.broadcasts_before;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        CREATE TRIGGER users_insert_mailbox
+        AFTER INSERT ON Users
+        REFERENCING NEW TABLE AS new_users
+        FOR EACH STATEMENT EXECUTE PROCEDURE mailboxes_add_users();''',
+        # a new broadcast is out of the inboxes of its sender and of the users
+        # who signed up after it (none but when importing older messages)
+        '''
+        CREATE OR REPLACE FUNCTION outboxes_add_messages() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO Outboxes (user_id, version)
+                SELECT DISTINCT sender_id, 1
+                FROM new_messages
+                ORDER BY sender_id
+            ON CONFLICT (user_id) DO UPDATE
+                SET version = Outboxes.version + 1;
+            IF EXISTS (SELECT 1 FROM new_messages WHERE broadcast) THEN
+                UPDATE Versions SET version = version + 1 WHERE name = 'broadcasts';
+                UPDATE Versions
+                SET version = version + (
+                    SELECT count(*) FROM new_messages WHERE broadcast)
+                WHERE name = 'broadcast_count';
+                UPDATE Mailboxes as b
+                SET broadcasts_before = b.broadcasts_before + d.before,
+                    broadcasts_opened = b.broadcasts_opened + d.opened
+                FROM (
+                    SELECT user_id, sum(before) as before, sum(opened) as opened
+                    FROM (
+                        SELECT sender_id as user_id, 0 as before, 1 as opened
+                        FROM new_messages
+                        WHERE broadcast
+                        UNION ALL
+                        SELECT u.user_id, 1, 0
+                        FROM new_messages as m, Users as u
+                        WHERE m.broadcast AND u.created_at > m.timestamp) as e
+                    GROUP BY user_id
+                    ORDER BY user_id) as d
+                WHERE b.user_id = d.user_id;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        # and back in them when it is removed, its receivers (those who opened
+        # it) are still there before the cascade
+        '''
+        CREATE OR REPLACE FUNCTION outboxes_remove_message() RETURNS trigger AS $$
+        BEGIN
+            UPDATE Outboxes SET version = version + 1 WHERE user_id = OLD.sender_id;
+            IF OLD.broadcast THEN
+                UPDATE Versions SET version = version + 1 WHERE name = 'broadcasts';
+                UPDATE Versions SET version = version - 1 WHERE name = 'broadcast_count';
+                UPDATE Mailboxes as b
+                SET broadcasts_before = b.broadcasts_before - d.before,
+                    broadcasts_opened = b.broadcasts_opened - d.opened
+                FROM (
+                    SELECT user_id, sum(before) as before, sum(opened) as opened
+                    FROM (
+                        SELECT OLD.sender_id as user_id, 0 as before, 1 as opened
+                        UNION ALL
+                        SELECT receiver_id, 0, 1
+                        FROM Receivers
+                        WHERE message_id = OLD.message_id
+                            AND timestamp = OLD.timestamp
+                        UNION ALL
+                        SELECT user_id, 1, 0
+                        FROM Users
+                        WHERE created_at > OLD.timestamp) as e
+                    GROUP BY user_id
+                    ORDER BY user_id) as d
+                WHERE b.user_id = d.user_id;
+            END IF;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        # the receivers of a broadcast are those who opened it, inserted read:
+        # the messages of the other receivers are not looked up
+        '''
+        CREATE OR REPLACE FUNCTION mailboxes_add_unread() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO Mailboxes (user_id, unread, version, broadcasts_opened)
+                SELECT r.receiver_id, count(*) FILTER (WHERE NOT r.message_read), 1,
+                    sum(CASE WHEN NOT r.message_read THEN 0
+                        WHEN EXISTS (
+                            SELECT 1 FROM Messages as m
+                            WHERE m.message_id = r.message_id
+                                AND m.timestamp = r.timestamp AND m.broadcast)
+                        THEN 1 ELSE 0 END)
+                FROM new_receivers as r
+                GROUP BY r.receiver_id
+                ORDER BY r.receiver_id
+            ON CONFLICT (user_id) DO UPDATE
+                SET unread = Mailboxes.unread + EXCLUDED.unread,
+                    version = Mailboxes.version + 1,
+                    broadcasts_opened =
+                        Mailboxes.broadcasts_opened + EXCLUDED.broadcasts_opened;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;''',
+        '''
+        INSERT INTO Mailboxes (user_id)
+            SELECT user_id FROM Users
+        ON CONFLICT (user_id) DO NOTHING;''',
+        '''
+        UPDATE Mailboxes as b
+        SET broadcasts_before = c.before
+        FROM (
+            SELECT user_id, count(*) FILTER (WHERE user_id IS NULL) OVER (
+                ORDER BY timestamp, user_id IS NULL
+                ROWS UNBOUNDED PRECEDING) as before
+            FROM (
+                SELECT user_id, created_at as timestamp FROM Users
+                UNION ALL
+                SELECT NULL, timestamp FROM Messages WHERE broadcast) as e
+            ) as c
+        WHERE b.user_id = c.user_id;''',
+        '''
+        UPDATE Mailboxes as b
+        SET broadcasts_opened = o.opened
+        FROM (
+            SELECT user_id, count(*) as opened
+            FROM (
+                SELECT sender_id as user_id
+                FROM Messages
+                WHERE broadcast
+                UNION ALL
+                SELECT r.receiver_id
+                FROM Receivers as r, Messages as m
+                WHERE m.broadcast AND r.message_id = m.message_id
+                    AND r.timestamp = m.timestamp) as e
+            GROUP BY user_id) as o
+        WHERE b.user_id = o.user_id;''',
+        "ANALYZE Users, Mailboxes;",
+        ], True),
+]
+
+# advisory lock serializing concurrent migration runs
+_LOCK_KEY = 0x6d696772
+
+def migrate(database_url, target_version=None):
+    """
+    Upgrade the database in place up to target_version (the latest one if
+    None), return the resulting schema version.
+    """
+    conn = ps.connect(database_url)
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_lock(%s);", [_LOCK_KEY])
+
+        cur.execute(
+            '''CREATE TABLE IF NOT EXISTS SchemaVersion (
+                version int PRIMARY KEY,
+                description text NOT NULL,
+                applied_at timestamp with time zone NOT NULL DEFAULT current_timestamp);''')
+        version = current_version(cur)
+
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            if target_version is not None and migration.version > target_version:
+                break
+
+            print("Applying migration %d: %s" %
+                (migration.version, migration.description))
+            conn.autocommit = not migration.transactional
+            with conn:
+                for step in migration.steps:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                cur.execute(
+                    "INSERT INTO SchemaVersion (version, description) VALUES (%s, %s);",
+                    [migration.version, migration.description])
+            conn.autocommit = True
+            version = migration.version
+
+        cur.execute("SELECT pg_advisory_unlock(%s);", [_LOCK_KEY])
+        cur.close()
+        return version
+    finally:
+        conn.close()
+
+def current_version(cursor) -> int:
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM SchemaVersion;")
+    return cursor.fetchone()[0]
+
+
+#===============================================================================
+# check if the module is being executed
+if __name__ == '__main__':
+    import sys
+
+    # get the db database
+    if len(sys.argv) > 2:
+        print("usage: python migrations.py <database_url>")
+    else:
+        database_url = db_utils.DEFAULT_DB if len(sys.argv) == 1 else sys.argv[1]
+        version = migrate(database_url)
+        print("Database schema at version %d" % version)
@@ -0,0 +1,126 @@
+import itertools
+import re
+import threading
+import weakref
+
+import psycopg2 as ps
+import psycopg2.errorcodes as errorcodes
+
+# Prepared statements of the hot queries. A statement is prepared the first
+# time a connection executes it and then run with EXECUTE, sparing the parse
+# and plan of every call. The statements are keyed by their SQL text, which
+# for the queries built on the fly (e.g. db_utils._users_query) is their shape
+# and not their values. The registry of a connection goes away with it, so a
+# new connection (e.g. replacing a broken one in the pool) prepares them again.
+
+# statements prepared per connection, the others are executed as is
+MAX_STATEMENTS = 256
+
+_registries = weakref.WeakKeyDictionary() # connection -> {sql: name}
+_names = itertools.count()
+_lock = threading.Lock()
+
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%s|%%")
+_converted = {} # sql -> (PREPARE body, parameter keys)
+
+def execute(cursor, sql:str, values=None):
+    """
+    Execute a query with psycopg2 placeholders (%s or %(name)s) through a
+    statement prepared on the connection of the cursor.
+    """
+    statement = _statement(cursor.connection, sql)
+    if statement is None:
+        return cursor.execute(sql, values)
+    name, prepare, keys = statement
+    try:
+        if prepare is not None:
+            cursor.execute(prepare)
+            _register(cursor.connection, sql, name)
+        return cursor.execute(_execute_sql(name, keys), _arguments(keys, values))
+    except ps.Error as e:
+        _check_error(cursor.connection, e)
+        raise
+
+async def execute_async(cursor, sql:str, values=None):
+    """
+    Same as execute for aiopg cursors.
+    """
+    statement = _statement(cursor.connection, sql)
+    if statement is None:
+        return await cursor.execute(sql, values)
+    name, prepare, keys = statement
+    try:
+        if prepare is not None:
+            await cursor.execute(prepare)
+            _register(cursor.connection, sql, name)
+        return await cursor.execute(
+            _execute_sql(name, keys), _arguments(keys, values))
+    except ps.Error as e:
+        _check_error(cursor.connection, e)
+        raise
+
+def _statement(connection, sql):
+    # (name, PREPARE statement or None if already prepared, parameter keys),
+    # None if the connection has too many prepared statements already
+    with _lock:
+        registry = _registries.setdefault(connection, {})
+        name = registry.get(sql)
+        if name is None and len(registry) >= MAX_STATEMENTS:
+            return None
+        converted = _converted.get(sql)
+    if converted is None:
+        converted = _convert(sql)
+        with _lock:
+            if len(_converted) < 4 * MAX_STATEMENTS:
+                _converted[sql] = converted
+    body, keys = converted
+    if name is not None:
+        return name, None, keys
+    with _lock:
+        name = "prepared_%d" % next(_names)
+    return name, "PREPARE %s AS %s" % (name, body), keys
+
+def _register(connection, sql, name):
+    with _lock:
+        _registries.setdefault(connection, {})[sql] = name
+
+def _check_error(connection, error):
+    # the statements are gone if the session was reset (e.g. DISCARD ALL),
+    # prepare them again from scratch on the next calls
+    if error.pgcode in (errorcodes.INVALID_SQL_STATEMENT_NAME,
+                        errorcodes.DUPLICATE_PREPARED_STATEMENT):
+        with _lock:
+            _registries.pop(connection, None)
+
+def _convert(sql):
+    """
+    Return the query with $n parameters and the key (position or name) of the
+    value of each parameter.
+    """
+    keys = []
+    positional = [0]
+
+    def _replace(match):
+        if match.group(0) == "%%":
+            return "%"
+        if match.group(1) is None:
+            key = positional[0]
+            positional[0] += 1
+        else:
+            key = match.group(1)
+            if key in keys:
+                return "$%d" % (keys.index(key) + 1)
+        keys.append(key)
+        return "$%d" % len(keys)
+
+    return _PLACEHOLDER.sub(_replace, sql).rstrip().rstrip(";"), keys
+
+def _execute_sql(name, keys):
+    if not keys:
+        return "EXECUTE %s;" % name
+    return "EXECUTE %s (%s);" % (name, ", ".join(["%s"] * len(keys)))
+
+def _arguments(keys, values):
+    if values is None:
+        return None
+    return [values[key] for key in keys]
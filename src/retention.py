@@ -0,0 +1,244 @@
+import argparse
+import datetime
+import gzip
+import os
+import re
+
+import psycopg2 as ps
+
+import db_utils
+
+# Retention of the messages, which are partitioned by month of their timestamp
+# (see migrations.py): the partitions of the coming months are created ahead,
+# and those older than the retention period are detached, optionally exported
+# to gzipped CSV files, and dropped. The counters and versions maintained by
+# the triggers are adjusted by hand, as detaching a partition fires none. The
+# message bodies no longer referenced are removed afterwards. A job stopped
+# after detaching a partition resumes from its export on the next run.
+
+_PARTITION = re.compile(r"^messages_p(\d{6})$")
+
+# partitions of Messages and detached ones (not yet dropped) with their state
+_PARTITIONS_SQL = '''
+    SELECT c.relname, i.inhparent IS NOT NULL
+    FROM pg_class as c
+    LEFT JOIN pg_inherits as i ON i.inhrelid = c.oid
+    WHERE c.relkind = 'r' AND c.relname ~ '^messages_p[0-9]{6}$'
+    ORDER BY c.relname;'''
+
+def run(database_url, keep_months=12, months_ahead=3, archive_dir=None):
+    """
+    Create the partitions of the next months_ahead months and archive those
+    of the months before the current one and the keep_months previous ones.
+    Return the suffixes (YYYYMM) of the archived months.
+    """
+    conn = ps.connect(database_url)
+    try:
+        cur = conn.cursor()
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        cur.execute(
+            "SELECT create_message_partitions(%s, %s);",
+            [today, _add_months(today, months_ahead)])
+        conn.commit()
+
+        cutoff = _add_months(today.replace(day=1), -keep_months).strftime("%Y%m")
+        cur.execute(_PARTITIONS_SQL)
+        partitions = [(_PARTITION.match(name).group(1), attached)
+            for name, attached in cur.fetchall()]
+        conn.commit()
+
+        archived = []
+        for suffix, attached in partitions:
+            if suffix >= cutoff:
+                continue
+            if attached:
+                detach(cur, suffix)
+            if archive_dir is not None:
+                export(cur, suffix, archive_dir)
+            cur.execute("DROP TABLE receivers_p%s, messages_p%s;" % (suffix, suffix))
+            conn.commit()
+            archived.append(suffix)
+            print("Archived the messages of %s" % suffix)
+
+        if archived:
+            print("Removed %d unused message bodies" % collect_bodies(cur))
+
+        cur.execute("SELECT EXISTS (SELECT 1 FROM messages_default);")
+        if cur.fetchone()[0]:
+            print("Warning: messages outside of the monthly partitions are "
+                  "stored in messages_default")
+        conn.commit()
+        cur.close()
+        return archived
+    finally:
+        conn.close()
+
+def detach(cursor, suffix):
+    """
+    Detach the partitions of a month, in a single transaction with the update
+    of the counters and of the versions of the listings they were part of.
+    """
+    with cursor.connection:
+        # no more reads marking them read or deletions of their messages
+        cursor.execute(
+            "LOCK TABLE messages_p{0}, receivers_p{0} IN SHARE ROW EXCLUSIVE MODE;"
+            .format(suffix))
+
+        # in the order of the triggers (Outboxes, Versions, Mailboxes)
+        cursor.execute(
+            '''
+            UPDATE Outboxes as o
+            SET version = o.version + 1
+            FROM (
+                SELECT DISTINCT sender_id FROM messages_p{0}
+                ORDER BY sender_id) as s
+            WHERE o.user_id = s.sender_id;'''.format(suffix))
+        cursor.execute(
+            '''
+            UPDATE Versions
+            SET version = version + 1
+            WHERE name = 'broadcasts'
+                AND EXISTS (SELECT 1 FROM messages_p{0} WHERE broadcast);'''
+            .format(suffix))
+        cursor.execute(
+            '''
+            UPDATE Versions
+            SET version = version - (
+                SELECT count(*) FROM messages_p{0} WHERE broadcast)
+            WHERE name = 'broadcast_count';'''.format(suffix))
+
+        # the receivers, and the broadcasts counted out of the inboxes of their
+        # senders, of those who opened them and of the users who signed up
+        # after them (see migration 11)
+        cursor.execute(
+            '''
+            UPDATE Mailboxes as b
+            SET unread = b.unread - d.unread,
+                version = b.version + 1,
+                broadcasts_before = b.broadcasts_before - d.before,
+                broadcasts_opened = b.broadcasts_opened - d.opened
+            FROM (
+                SELECT user_id, sum(unread) as unread, sum(before) as before,
+                    sum(opened) as opened
+                FROM (
+                    SELECT r.receiver_id as user_id,
+                        (NOT r.message_read)::int as unread, 0 as before,
+                        m.broadcast::int as opened
+                    FROM receivers_p{0} as r, messages_p{0} as m
+                    WHERE m.message_id = r.message_id
+                    UNION ALL
+                    SELECT sender_id, 0, 0, 1
+                    FROM messages_p{0}
+                    WHERE broadcast
+                    UNION ALL
+                    SELECT u.user_id, 0, 1, 0
+                    FROM messages_p{0} as m, Users as u
+                    WHERE m.broadcast AND u.created_at > m.timestamp) as e
+                GROUP BY user_id
+                ORDER BY user_id) as d
+            WHERE b.user_id = d.user_id;'''.format(suffix))
+
+        # the references to the partitions must go before detaching them
+        cursor.execute(
+            '''
+            DELETE FROM SendJobs
+            WHERE message_id IN (SELECT message_id FROM messages_p{0});'''
+            .format(suffix))
+        cursor.execute(
+            "ALTER TABLE Receivers DETACH PARTITION receivers_p%s;" % suffix)
+        cursor.execute(
+            '''
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = %s::regclass AND contype = 'f'
+                AND confrelid = 'messages'::regclass;''',
+            ["receivers_p" + suffix])
+        for name, in cursor.fetchall():
+            cursor.execute('ALTER TABLE receivers_p%s DROP CONSTRAINT "%s";' %
+                (suffix, name))
+        cursor.execute(
+            "ALTER TABLE Messages DETACH PARTITION messages_p%s;" % suffix)
+
+def export(cursor, suffix, directory):
+    """
+    Export the detached partitions of a month into messages_pYYYYMM.csv.gz
+    (with the bodies as stored, see bodies.decode) and receivers_pYYYYMM.csv.gz,
+    streamed from COPY.
+    """
+    os.makedirs(directory, exist_ok=True)
+    queries = {
+        "messages_p" + suffix: '''
+            SELECT m.message_id, m.sender_id, m.timestamp, m.broadcast,
+                b.compressed, b.body
+            FROM messages_p{0} as m
+            JOIN MessageBodies as b ON b.body_hash = m.body_hash
+            ORDER BY m.message_id'''.format(suffix),
+        "receivers_p" + suffix: '''
+            SELECT message_id, receiver_id, message_read, timestamp
+            FROM receivers_p{0}
+            ORDER BY message_id, receiver_id'''.format(suffix),
+    }
+    for name, query in queries.items():
+        # complete files only, a failed export is done again
+        path = os.path.join(directory, name + ".csv.gz")
+        with gzip.open(path + ".tmp", "wb") as f:
+            cursor.copy_expert(
+                "COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)" % query, f)
+        cursor.connection.commit()
+        os.replace(path + ".tmp", path)
+
+# batch of bodies (in hash order) locked for their removal, skipping those
+# locked by the messages being sent with them (see db_utils._INSERT_BODY_CTE)
+_LOCK_BODIES_SQL = '''
+    SELECT body_hash FROM MessageBodies
+    WHERE body_hash > %(after)s
+    ORDER BY body_hash
+    LIMIT %(limit)s
+    FOR UPDATE SKIP LOCKED;'''
+
+# the locked bodies no message references, checked by a later statement than
+# the lock so that the messages committed until then are seen
+_COLLECT_BODIES_SQL = '''
+    DELETE FROM MessageBodies as b
+    WHERE b.body_hash = ANY(%(batch)s::bytea[])
+        AND NOT EXISTS (
+            SELECT 1 FROM Messages as m
+            WHERE m.body_hash = b.body_hash);'''
+
+def collect_bodies(cursor, batch_size=10000):
+    """
+    Remove the message bodies no message references, one transaction per
+    batch. Return how many were removed.
+    """
+    removed = 0
+    after = b""
+    while True:
+        with cursor.connection:
+            cursor.execute(
+                _LOCK_BODIES_SQL, {"after": after, "limit": batch_size})
+            batch = [bytes(row[0]) for row in cursor.fetchall()]
+            if not batch:
+                return removed
+            cursor.execute(_COLLECT_BODIES_SQL, {"batch": batch})
+            removed += cursor.rowcount
+        after = batch[-1]
+
+def _add_months(date, months):
+    month = date.month - 1 + months
+    return date.replace(year=date.year + month // 12, month=month % 12 + 1, day=1)
+
+
+#===============================================================================
+# check if the module is being executed
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Archive the old messages and prepare the next partitions")
+    parser.add_argument("database_url", nargs="?", default=db_utils.DEFAULT_DB)
+    parser.add_argument("--keep-months", type=int, default=12,
+        help="months kept before the current one")
+    parser.add_argument("--months-ahead", type=int, default=3,
+        help="months partitioned ahead of the current one")
+    parser.add_argument("--archive-dir",
+        help="directory of the exported months (not exported if omitted)")
+    args = parser.parse_args()
+
+    run(args.database_url, args.keep_months, args.months_ahead, args.archive_dir)
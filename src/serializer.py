@@ -0,0 +1,121 @@
+import datetime
+import json
+from json.encoder import encode_basestring_ascii
+
+# JSON encoding of query results straight from the row tuples, the encoder of
+# each column is chosen once from the type in the cursor description instead
+# of building (and then inspecting) one dict per row.
+
+class Rows(list):
+    """
+    The row tuples of a query with the description of its columns.
+    """
+
+    def __init__(self, rows, description):
+        super().__init__(rows)
+        self.description = description
+        self.columns = [column[0] for column in description]
+
+    def last(self, column):
+        """
+        Return the value of the given column in the last row.
+        """
+        return self[-1][self.columns.index(column)]
+
+def _encode_int(value):
+    return "null" if value is None else "%d" % value
+
+def _encode_bool(value):
+    return "null" if value is None else ("true" if value else "false")
+
+def _encode_text(value):
+    return "null" if value is None else encode_basestring_ascii(value)
+
+def _encode_timestamp(value):
+    # same format as the connexion JSON encoder
+    if value is None:
+        return "null"
+    if value.tzinfo is None:
+        return '"' + value.isoformat() + 'Z"'
+    return '"' + value.isoformat() + '"'
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return _encode_timestamp(value)[1:-1]
+    raise TypeError(repr(value))
+
+def _encode_json(value):
+    return json.dumps(value, default=_json_default)
+
+# postgres type oids -> (placeholder and expression of the fast path,
+# encoder of the slow path handling NULLs)
+_ENCODERS = {
+    16: ("%s", "_BOOLS[{}]", _encode_bool),                            # bool
+    20: ("%d", "{}", _encode_int),                                     # int8
+    21: ("%d", "{}", _encode_int),                                     # int2
+    23: ("%d", "{}", _encode_int),                                     # int4
+    25: ("%s", "_encode_text({})", _encode_text),                      # text
+    1043: ("%s", "_encode_text({})", _encode_text),                    # varchar
+    1114: ('"%sZ"', "{}.isoformat()", _encode_timestamp),              # timestamp
+    1184: ('"%s"', "{}.isoformat()", _encode_timestamp),               # timestamptz
+}
+
+_BOOLS = {True: "true", False: "false"}
+
+def row_encoder(description):
+    """
+    Return a function encoding a row with the given description into a JSON
+    object (as a str) keyed by the column names.
+    """
+    names = [encode_basestring_ascii(column[0]).replace("%", "%%")
+        for column in description]
+    encoders = [_ENCODERS.get(column[1], ("%s", None, _encode_json))
+        for column in description]
+    slow_encoders = [slow for _, _, slow in encoders]
+    slow_template = "{" + ",".join(name + ":%s" for name in names) + "}"
+
+    # the fast path is compiled for the columns at hand (as namedtuple does),
+    # it fails on NULL values, such rows are encoded column by column
+    fast_template = "{" + ",".join(
+        name + ":" + placeholder
+        for name, (placeholder, _, _) in zip(names, encoders)) + "}"
+    expressions = [
+        ("_slow[%d]({})" % i if expression is None else expression).format(
+            "row[%d]" % i)
+        for i, (_, expression, _) in enumerate(encoders)]
+    fast_encode = eval(
+        "lambda row: _template % (" + ", ".join(expressions) + ",)",
+        {"_template": fast_template,
+         "_slow": slow_encoders,
+         "_BOOLS": _BOOLS,
+         "_encode_text": encode_basestring_ascii})
+
+    def encode(row):
+        try:
+            return fast_encode(row)
+        except (TypeError, AttributeError, KeyError):
+            return slow_template % tuple(
+                [encode(value) for encode, value in zip(slow_encoders, row)])
+    return encode
+
+def dumps(rows:Rows) -> bytes:
+    """
+    Encode rows into a JSON array of objects.
+    """
+    encode = row_encoder(rows.description)
+    return ("[" + ",".join([encode(row) for row in rows]) + "]").encode()
+
+def iter_dumps(chunks):
+    """
+    Encode an iterator of Rows chunks into a JSON array, one piece of the
+    array (as bytes) per chunk.
+    """
+    yield b"["
+    encode = None
+    separator = ""
+    for rows in chunks:
+        if encode is None:
+            encode = row_encoder(rows.description)
+        yield (separator + ",".join([encode(row) for row in rows])).encode()
+        separator = ","
+    yield b"]"
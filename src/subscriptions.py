@@ -0,0 +1,77 @@
+import asyncio
+import collections
+import json
+import queue
+import threading
+
+
+class Subscriptions:
+    """
+    In-process registry of the clients waiting for new messages, fed by the
+    notifications on db_utils.NEW_MESSAGE_CHANNEL received by the shared
+    listener connection.
+
+    Every subscriber owns a bounded queue of events, a subscriber too slow to
+    consume them gets a "resync" event instead and should re-read its inbox.
+    The queues are queue.Queue by default, asyncio.Queue in the async serving
+    mode (where publish is called from the event loop).
+    """
+
+    def __init__(self, max_pending:int=100, queue_class=queue.Queue):
+        self.max_pending = max_pending
+        self.queue_class = queue_class
+        self._queues = collections.defaultdict(set) # user_id -> queues
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id:int):
+        events = self.queue_class(self.max_pending)
+        with self._lock:
+            self._queues[user_id].add(events)
+        return events
+
+    def unsubscribe(self, user_id:int, events):
+        with self._lock:
+            queues = self._queues.get(user_id)
+            if queues is not None:
+                queues.discard(events)
+                if not queues:
+                    del self._queues[user_id]
+
+    def publish(self, payload:str):
+        """
+        Dispatch a new message notification to the subscribed receivers.
+        """
+        notification = json.loads(payload)
+        event = ("message", {"message_id": notification["message_id"],
+                             "sender_id": notification["sender_id"]})
+        with self._lock:
+            if notification["receiver_ids"] is None: # broadcast
+                targets = [q for user_id, queues in self._queues.items()
+                    if user_id != notification["sender_id"] for q in queues]
+            else:
+                targets = [q for user_id in notification["receiver_ids"]
+                    for q in self._queues.get(user_id, ())]
+        for events in targets:
+            _put(events, event)
+
+    def resync(self):
+        """
+        Tell every subscriber that some notifications may have been lost.
+        """
+        with self._lock:
+            targets = [q for queues in self._queues.values() for q in queues]
+        for events in targets:
+            _put(events, ("resync", {}))
+
+
+def _put(events, event):
+    try:
+        events.put_nowait(event)
+    except (queue.Full, asyncio.QueueFull):
+        # drop the backlog, the client has to re-read its inbox anyway
+        while True:
+            try:
+                events.get_nowait()
+            except (queue.Empty, asyncio.QueueEmpty):
+                break
+        events.put_nowait(("resync", {}))
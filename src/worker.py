@@ -0,0 +1,93 @@
+# standard modules
+import logging
+import os
+import select
+import signal
+import sys
+
+# third party modules
+import psycopg2 as ps
+
+# custom modules
+import db_utils
+
+logger = logging.getLogger(__name__)
+
+running = True
+
+def stop(signum, frame):
+    global running
+    running = False
+
+def main(database_url, batch_size, poll_interval):
+    """
+    Deliver the deferred messages queued in SendJobs, one batch of receivers
+    per transaction, sleeping until a new job is announced when idle.
+    """
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    conn = None
+    try:
+        while running:
+            try:
+                if conn is None:
+                    conn = _connect(database_url)
+                    cur = conn.cursor()
+
+                job_id = db_utils.deliver_job_batch(cur, batch_size)
+                if job_id is None: # queue empty, wait for a notification
+                    select.select([conn], [], [], poll_interval)
+                    conn.poll()
+                    conn.notifies.clear()
+
+            except (ps.OperationalError, ps.InterfaceError):
+                # the connection is gone, reconnect and listen again
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                select.select([], [], [], poll_interval)
+
+            except ps.Error:
+                # the batch is rolled back and tried again after a while, on
+                # a new connection if the rollback fails too
+                logger.exception("Delivery of a batch failed")
+                if conn is not None:
+                    try:
+                        conn.rollback()
+                    except ps.Error:
+                        conn.close()
+                        conn = None
+                select.select([], [], [], poll_interval)
+    finally:
+        if conn is not None:
+            conn.close()
+        print('Delivery worker stopped')
+
+def _connect(database_url):
+    conn = ps.connect(database_url)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("LISTEN " + db_utils.SEND_JOBS_CHANNEL + ";")
+        conn.commit()
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+if __name__ == '__main__':
+    # check if the worker is running on heroku (parameter --heroku)
+    arg_set = set(sys.argv[1:])
+    if "--heroku" in arg_set:
+        arg_set.remove("--heroku")
+        database_url = os.environ['DATABASE_URL']
+    else:
+        database_url = db_utils.DEFAULT_DB
+
+    if len(arg_set) != 0:
+        print("Wrong synthax, usage: worker.py [--heroku]")
+    else:
+        main(database_url=database_url,
+             batch_size=int(os.environ.get('SEND_BATCH_SIZE', 1000)),
+             poll_interval=float(os.environ.get('SEND_POLL_INTERVAL', 5.0)))
@@ -0,0 +1,6 @@
+# WSGI entry point of the production server, see gunicorn_conf.py. The
+# database connections are opened by each worker after the fork.
+import main
+
+app = main.create_app(debug=False)
+application = app.app